@@ -0,0 +1,135 @@
+import time
+import typing as t
+from array import array
+from bisect import bisect_left
+
+NONE = -1
+
+
+class ApplicantIndex:
+    """
+    Компактный индекс кандидатов для синхронизации статусов.
+    Строки applicants хранятся в параллельных массивах array('q'), отсортированных по id
+    (ids, hf_ids, statuses), отсутствующие значения хранятся как NONE.
+    Для поиска по id кандидата в Huntflow есть отсортированная пара массивов hf_keys -> hf_owner_ids.
+    Индекс строится из строк базы (load) и обновляется на месте изменениями (apply),
+    изменения, пришедшие во время перестроения, применяются после него
+    """
+
+    def __init__(self) -> None:
+        self.ids = array('q')
+        self.hf_ids = array('q')
+        self.statuses = array('q')
+        self.hf_keys = array('q')
+        self.hf_owner_ids = array('q')
+        self.built_at: t.Optional[float] = None
+        self.complete = False
+        self._replay: t.Optional[t.List[t.Dict[str, t.Any]]] = None
+        self._building: t.Optional[t.Tuple['array[int]', 'array[int]', 'array[int]']] = None
+
+    def __len__(self) -> int:
+        return len(self.hf_keys)
+
+    def is_fresh(self, max_age: float) -> bool:
+        return self.built_at is not None and time.monotonic() - self.built_at < max_age
+
+    def invalidate(self) -> None:
+        self.built_at = None
+
+    def begin_rebuild(self) -> None:
+        self._replay = []
+        self._building = (array('q'), array('q'), array('q'))
+
+    def add_row(self, id_: int, hf_id: t.Optional[int], status_id: t.Optional[int]) -> None:
+        """
+        Добавляет строку в перестраиваемый индекс; строки должны идти по возрастанию id
+        """
+        assert self._building is not None
+        ids, hf_ids, statuses = self._building
+        ids.append(id_)
+        hf_ids.append(NONE if hf_id is None else hf_id)
+        statuses.append(NONE if status_id is None else status_id)
+
+    def cancel_rebuild(self) -> None:
+        self._replay = None
+        self._building = None
+
+    def finish_rebuild(self, complete: bool = True) -> None:
+        """
+        Заменяет индекс перестроенным. complete=False - в индекс попали не все кандидаты
+        """
+        assert self._building is not None
+        ids, hf_ids, statuses = self._building
+        self._building = None
+        hf_order = sorted((ind for ind, hf_id in enumerate(hf_ids) if hf_id != NONE), key=hf_ids.__getitem__)
+        self.ids, self.hf_ids, self.statuses = ids, hf_ids, statuses
+        self.hf_keys = array('q', (hf_ids[ind] for ind in hf_order))
+        self.hf_owner_ids = array('q', (ids[ind] for ind in hf_order))
+
+        replay, self._replay = self._replay or [], None
+        for change in replay:
+            self.apply(change)
+        self.complete = complete
+        self.built_at = time.monotonic()
+
+    def load(self, rows: t.Iterable[t.Any], complete: bool = True) -> None:
+        """
+        Перестраивает индекс по строкам (id, applicant_id, status_id), отсортированным по id
+        """
+        if self._building is None:
+            self.begin_rebuild()
+        for row in rows:
+            self.add_row(row['id'], row['applicant_id'], row['status_id'])
+        self.finish_rebuild(complete)
+
+    def _position(self, id_: int) -> int:
+        pos = bisect_left(self.ids, id_)
+        return pos if pos < len(self.ids) and self.ids[pos] == id_ else NONE
+
+    def get(self, hf_id: int) -> t.Optional[t.Tuple[int, t.Optional[int]]]:
+        """
+        (id, status_id) кандидата по его id в Huntflow
+        """
+        hf_pos = bisect_left(self.hf_keys, hf_id)
+        if hf_pos == len(self.hf_keys) or self.hf_keys[hf_pos] != hf_id:
+            return None
+        id_ = self.hf_owner_ids[hf_pos]
+        status = self.statuses[self._position(id_)]
+        return id_, None if status == NONE else status
+
+    def statuses_in_huntflow(self) -> t.Iterator[t.Optional[int]]:
+        for hf_id, status in zip(self.hf_ids, self.statuses):
+            if hf_id != NONE:
+                yield None if status == NONE else status
+
+    def apply(self, change: t.Dict[str, t.Any]) -> None:
+        """
+        Применяет изменение строки: id и, если есть и не None, applicant_id и status_id
+        """
+        if self._replay is not None:
+            self._replay.append(change)
+
+        id_ = change['id']
+        pos = self._position(id_)
+        if pos == NONE:
+            pos = bisect_left(self.ids, id_)
+            self.ids.insert(pos, id_)
+            self.hf_ids.insert(pos, NONE)
+            self.statuses.insert(pos, NONE)
+
+        hf_id = change.get('applicant_id')
+        if hf_id is not None and hf_id != self.hf_ids[pos]:
+            if self.hf_ids[pos] != NONE:
+                old_pos = bisect_left(self.hf_keys, self.hf_ids[pos])
+                del self.hf_keys[old_pos]
+                del self.hf_owner_ids[old_pos]
+            hf_pos = bisect_left(self.hf_keys, hf_id)
+            self.hf_keys.insert(hf_pos, hf_id)
+            self.hf_owner_ids.insert(hf_pos, id_)
+            self.hf_ids[pos] = hf_id
+
+        if change.get('status_id') is not None:
+            self.statuses[pos] = change['status_id']
+
+
+applicant_index: ApplicantIndex = ApplicantIndex()
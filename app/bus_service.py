@@ -12,6 +12,7 @@ import settings
 listener: Listener = Listener(
     dsn=settings.SERVICE_BUS_DSN,
     service_name=settings.SERVICE_NAME,
+    prefetch_count=settings.BUS_PREFETCH,
 )
 
 sender = Sender(
@@ -1,20 +1,236 @@
+import asyncio
+import contextvars
+import datetime as dt
+import json
+import logging
 import typing as t
+import uuid
+from collections import Counter
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from contextlib import contextmanager
 from typing import AsyncGenerator
 
+import asyncpg
+import sqlalchemy
+from bus import Event
 from databases import Database
+from databases.core import Connection
+from sqlalchemy.dialects.postgresql import insert
 
 import settings
+from app.applicant_index import applicant_index
+from app.metrics import DB_POOL_WAIT_SECONDS
+from app.metrics import db_query
 from app.models import SyncError
 from app.models import applicants_table
+from app.models import outbox_table
+from app.models import pending_operations_table
+from app.models import rejection_reasons_table
+from app.models import sync_cursors_table
+from app.models import uploaded_files_table
+
+database: Database = Database(
+    settings.DB_DSN,
+    min_size=settings.DB_POOL_MIN_SIZE,
+    max_size=settings.DB_POOL_MAX_SIZE,
+    statement_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+APPLICANTS_CHANNEL = 'applicants_changed'
+
+_pool_slots: t.Optional[asyncio.Semaphore] = None
+
+
+class ApplicantCache:
+    """
+    LRU-кэш строк applicants по id. Обновляется при записи через функции этого модуля.
+    Если включён DB_APPLICANTS_CACHE_NOTIFY, записи других реплик приходят через LISTEN/NOTIFY
+    и сбрасывают соответствующие строки.
+    Строка, прочитанная из базы (fetched), не кладётся в кэш, если за время чтения её изменили или сбросили
+    """
+
+    def __init__(self, size: int, enabled: bool = True):
+        self.size = size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.origin = uuid.uuid4().hex
+        self._rows: 't.OrderedDict[int, t.Dict[str, t.Any]]' = OrderedDict()
+        self._fetching: t.Counter[int] = Counter()
+        self._stale: t.Set[int] = set()
+        self._listen_connection: t.Optional[asyncpg.Connection] = None
+
+    def get(self, id_: int) -> t.Optional[t.Dict[str, t.Any]]:
+        row = self._rows.get(id_)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rows.move_to_end(id_)
+        return dict(row)
+
+    def put(self, id_: int, row: t.Dict[str, t.Any]) -> None:
+        if not self.enabled:
+            return
+        self._rows[id_] = dict(row)
+        self._rows.move_to_end(id_)
+        while len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+
+    @contextmanager
+    def fetching(self, id_: int) -> t.Iterator[t.Callable[[t.Dict[str, t.Any]], None]]:
+        """
+        Оборачивает чтение строки из базы и отдаёт функцию, которая кладёт прочитанную строку в кэш
+        """
+        self._fetching[id_] += 1
+
+        def put_fetched(row: t.Dict[str, t.Any]) -> None:
+            if id_ not in self._stale:
+                self.put(id_, row)
+
+        try:
+            yield put_fetched
+        finally:
+            self._fetching[id_] -= 1
+            if not self._fetching[id_]:
+                del self._fetching[id_]
+                self._stale.discard(id_)
+
+    def _changed(self, id_: int) -> None:
+        if id_ in self._fetching:
+            self._stale.add(id_)
+
+    def update(self, id_: int, values: t.Dict[str, t.Any]) -> None:
+        self._changed(id_)
+        if id_ in self._rows:
+            self._rows[id_].update(values)
+
+    def invalidate(self, id_: int) -> None:
+        self._changed(id_)
+        self._rows.pop(id_, None)
+
+    def clear(self) -> None:
+        self._stale.update(self._fetching)
+        self._rows.clear()
+
+    @property
+    def listening(self) -> bool:
+        return self._listen_connection is not None
+
+    async def listen(self) -> None:
+        self._listen_connection = await asyncpg.connect(settings.DB_DSN)
+        await self._listen_connection.add_listener(APPLICANTS_CHANNEL, self._on_notification)
+        self._listen_connection.add_termination_listener(self._on_listen_connection_lost)
+
+    async def stop_listening(self) -> None:
+        if self._listen_connection is not None:
+            connection, self._listen_connection = self._listen_connection, None
+            await connection.close()
+
+    def _on_notification(self, connection: t.Any, pid: int, channel: str, payload: str) -> None:
+        notification = json.loads(payload)
+        if notification['origin'] == self.origin:
+            return
+        for change in notification['changes']:
+            self.invalidate(change['id'])
+            applicant_index.apply(change)
+
+    def _on_listen_connection_lost(self, connection: t.Any) -> None:
+        if self._listen_connection is None:
+            return
+        logger.warning('Lost %s listener connection, dropping applicants cache', APPLICANTS_CHANNEL)
+        self.clear()
+        applicant_index.invalidate()
+        self._listen_connection = None
+        asyncio.ensure_future(self._relisten())
+
+    async def _relisten(self) -> None:
+        while self._listen_connection is None:
+            try:
+                await self.listen()
+            except Exception as e:
+                logger.exception(str(e))
+                await asyncio.sleep(settings.DB_APPLICANTS_CACHE_RELISTEN_DELAY)
+            self.clear()
+
+
+applicants_cache = ApplicantCache(settings.DB_APPLICANTS_CACHE_SIZE, enabled=settings.DB_APPLICANTS_CACHE_ENABLED)
+
+
+async def connect_pool() -> None:
+    global _pool_slots
+    if not database.is_connected:
+        await database.connect()
+    if _pool_slots is None:
+        _pool_slots = asyncio.Semaphore(settings.DB_POOL_MAX_SIZE)
+    if applicants_cache.enabled and settings.DB_APPLICANTS_CACHE_NOTIFY and not applicants_cache.listening:
+        await applicants_cache.listen()
+
+
+async def close_pool() -> None:
+    global _pool_slots
+    await applicants_cache.stop_listening()
+    applicants_cache.clear()
+    applicant_index.invalidate()
+    if database.is_connected:
+        await database.disconnect()
+    _pool_slots = None
 
 
 @asynccontextmanager
-async def connect_database() -> AsyncGenerator[Database, None]:
-    async with Database(settings.DB_DSN) as db:
-        yield db
+async def connect_database() -> AsyncGenerator[Connection, None]:
+    """
+    Берёт соединение из общего пула процесса.
+    Если свободного соединения нет дольше DB_POOL_ACQUIRE_TIMEOUT секунд, бросается asyncio.TimeoutError
+    """
+    if _pool_slots is None:
+        await connect_pool()
+    assert _pool_slots is not None
+    with DB_POOL_WAIT_SECONDS.time():
+        await asyncio.wait_for(_pool_slots.acquire(), timeout=settings.DB_POOL_ACQUIRE_TIMEOUT)
+    try:
+        async with database.connection() as connection:
+            yield connection
+    finally:
+        _pool_slots.release()
+
+
+T = t.TypeVar('T')
+
+
+def spawn(coro: t.Awaitable[T]) -> 'asyncio.Future[T]':
+    """
+    Запускает задачу в пустом контексте. databases хранит соединение задачи в ContextVar, и задача,
+    созданная обычным ensure_future, наследует соединение родителя: запросы всех таких задач идут по очереди
+    через одно соединение, а их транзакции вкладываются друг в друга. Здесь задача берёт своё соединение из пула
+    """
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
 
+async def _applicants_changed(db: Connection, changes: t.Sequence[t.Dict[str, t.Any]]) -> None:
+    for change in changes:
+        applicants_cache.update(change['id'], change)
+        applicant_index.apply(change)
+    if not settings.DB_APPLICANTS_CACHE_NOTIFY:
+        return
+    for ind in range(0, len(changes), 100):
+        payload = {
+            'origin': applicants_cache.origin,
+            'changes': [
+                {key: value for key, value in change.items() if key in ('id', 'applicant_id', 'status_id')}
+                for change in changes[ind:ind + 100]
+            ],
+        }
+        await db.execute(
+            query='SELECT pg_notify(:channel, :payload)',
+            values={'channel': APPLICANTS_CHANNEL, 'payload': json.dumps(payload)},
+        )
 
+
+@db_query
 async def create_applicant(
     id_: int, applicant_id: t.Optional[int] = None, status_id: t.Optional[int] = None
 ) -> None:
@@ -26,8 +242,11 @@ async def create_applicant(
     }
     async with connect_database() as db:
         await db.execute(query=query, values=values)
+        applicants_cache.put(id_, dict(values, files_ids=None, last_sync_error=None))
+        await _applicants_changed(db, [values])
 
 
+@db_query
 async def update_applicant(
     id_: int,
     applicant_id: t.Optional[int] = None,
@@ -52,16 +271,284 @@ async def update_applicant(
     )
     async with connect_database() as db:
         await db.execute(query=query)
+        await _applicants_changed(db, [dict(values, id=id_)])
+
+
+@db_query
+async def update_applicants_statuses(
+    changes: t.Sequence[t.Tuple[int, t.Optional[int], t.Optional[SyncError]]],
+    events: t.Sequence[Event] = (),
+) -> t.Set[int]:
+    """
+    Применяет пачку изменений (id, status_id, last_sync_error) одним запросом UPDATE ... FROM (VALUES ...).
+    None означает, что поле не меняется. Строка со статусом меняется, только если статус в базе другой:
+    так смену статуса, которую одновременно применяют вебхук и синхронизация (или две реплики), применит один из них.
+    В той же транзакции в outbox записываются события events тех кандидатов (event.id), чьи строки изменились.
+    Возвращает id изменённых строк
+    """
+    if not changes:
+        return set()
+    rows = []
+    values: t.Dict[str, t.Any] = {}
+    for ind, (id_, status_id, last_sync_error) in enumerate(changes):
+        rows.append(
+            f'(CAST(:id_{ind} AS INTEGER), CAST(:status_id_{ind} AS INTEGER), '
+            f'CAST(:last_sync_error_{ind} AS sync_error))'
+        )
+        values[f'id_{ind}'] = id_
+        values[f'status_id_{ind}'] = status_id
+        values[f'last_sync_error_{ind}'] = last_sync_error.name if last_sync_error is not None else None
+
+    query = (
+        'UPDATE applicants SET '
+        'status_id = COALESCE(v.status_id, applicants.status_id), '
+        'last_sync_error = COALESCE(v.last_sync_error, applicants.last_sync_error) '
+        f'FROM (VALUES {", ".join(rows)}) AS v (id, status_id, last_sync_error) '
+        'WHERE applicants.id = v.id '
+        'AND (v.status_id IS NULL OR applicants.status_id IS DISTINCT FROM v.status_id) '
+        'RETURNING applicants.id'
+    )
+    async with connect_database() as db:
+        async with db.transaction():
+            updated = {row['id'] for row in await db.fetch_all(query=query, values=values)}
+            events = [event for event in events if getattr(event, 'id', None) in updated]
+            if events:
+                now = dt.datetime.utcnow()
+                await db.execute(query=outbox_table.insert().values([
+                    {'event_type': type(event).__name__, 'payload': event.json(), 'created_at': now}
+                    for event in events
+                ]))
+        await _applicants_changed(db, [
+            {
+                key: value for key, value in
+                (('id', id_), ('status_id', status_id), ('last_sync_error', last_sync_error))
+                if value is not None
+            }
+            for id_, status_id, last_sync_error in changes
+            if id_ in updated
+        ])
+    return updated
 
 
+@db_query
 async def get_applicant_by_id(id_: int) -> t.Any:
+    cached = applicants_cache.get(id_) if applicants_cache.enabled else None
+    if cached is not None:
+        return cached
+
     query = applicants_table.select().where(
         applicants_table.c.id == id_
     )
+    with applicants_cache.fetching(id_) as put_fetched:
+        async with connect_database() as db:
+            applicant = await db.fetch_one(query=query)
+        if applicant is None:
+            return None
+        put_fetched(dict(applicant))
+    return dict(applicant)
+
+
+@db_query
+async def get_applicant_by_hf_id(applicant_id: int) -> t.Any:
+    query = applicants_table.select().where(
+        applicants_table.c.applicant_id == applicant_id
+    )
     async with connect_database() as db:
         return await db.fetch_one(query=query)
 
 
+@db_query
 async def get_all_applicants() -> t.Any:
     async with connect_database() as db:
         return await db.fetch_all(query=applicants_table.select())
+
+
+async def iterate_applicant_index_rows(exclude_statuses: t.Sequence[int] = ()) -> t.AsyncGenerator[t.Any, None]:
+    """
+    Строки (id, applicant_id, status_id) по возрастанию id, читаются курсором без загрузки всей таблицы в память.
+    Если задан exclude_statuses, отдаются только кандидаты из Huntflow не в этих статусах
+    """
+    query = sqlalchemy.select(
+        [applicants_table.c.id, applicants_table.c.applicant_id, applicants_table.c.status_id]
+    ).order_by(applicants_table.c.id)
+    if exclude_statuses:
+        query = query.where(applicants_table.c.applicant_id.isnot(None)).where(
+            applicants_table.c.status_id.is_(None) | applicants_table.c.status_id.notin_(exclude_statuses)
+        )
+    async with connect_database() as db:
+        async for row in db.iterate(query=query):
+            yield row
+
+
+@db_query
+async def get_sync_cursors() -> t.Dict[int, t.Any]:
+    async with connect_database() as db:
+        return {
+            cursor['status_id']: cursor
+            for cursor in await db.fetch_all(query=sync_cursors_table.select())
+        }
+
+
+@db_query
+async def save_sync_cursor(
+    status_id: int, synced_at: dt.datetime, full_synced_at: t.Optional[dt.datetime] = None
+) -> None:
+    values: t.Dict[str, t.Any] = {'synced_at': synced_at}
+    if full_synced_at is not None:
+        values['full_synced_at'] = full_synced_at
+    query = insert(sync_cursors_table).values(status_id=status_id, **values)
+    query = query.on_conflict_do_update(index_elements=[sync_cursors_table.c.status_id], set_=values)
+    async with connect_database() as db:
+        await db.execute(query=query)
+
+
+@db_query
+async def get_uploaded_file(key: str, used_after: dt.datetime) -> t.Any:
+    query = uploaded_files_table.select().where(
+        (uploaded_files_table.c.key == key) & (uploaded_files_table.c.last_used_at >= used_after)
+    )
+    async with connect_database() as db:
+        uploaded_file = await db.fetch_one(query=query)
+        if uploaded_file is not None:
+            await db.execute(
+                query=uploaded_files_table.update()
+                .where(uploaded_files_table.c.key == key)
+                .values(last_used_at=dt.datetime.utcnow())
+            )
+        return uploaded_file
+
+
+@db_query
+async def save_uploaded_file(keys: t.Sequence[str], file_id: int, size: int) -> None:
+    now = dt.datetime.utcnow()
+    query = insert(uploaded_files_table).values([
+        {'key': key, 'file_id': file_id, 'size': size, 'created_at': now, 'last_used_at': now}
+        for key in keys
+    ])
+    query = query.on_conflict_do_update(
+        index_elements=[uploaded_files_table.c.key],
+        set_={'file_id': query.excluded.file_id, 'size': query.excluded.size, 'last_used_at': now},
+    )
+    async with connect_database() as db:
+        await db.execute(query=query)
+
+
+@db_query
+async def delete_uploaded_files(used_before: dt.datetime) -> None:
+    query = uploaded_files_table.delete().where(uploaded_files_table.c.last_used_at < used_before)
+    async with connect_database() as db:
+        await db.execute(query=query)
+
+
+@db_query
+async def get_rejection_reasons() -> t.Tuple[t.Dict[int, str], t.Optional[dt.datetime]]:
+    async with connect_database() as db:
+        rows = await db.fetch_all(query=rejection_reasons_table.select())
+    return {row['id']: row['name'] for row in rows}, min((row['updated_at'] for row in rows), default=None)
+
+
+@db_query
+async def save_rejection_reasons(reasons: t.Dict[int, str]) -> None:
+    """
+    Заменяет снимок справочника причин отказа. Запись через upsert, поэтому реплики могут сохранять его одновременно
+    """
+    now = dt.datetime.utcnow()
+    async with connect_database() as db:
+        async with db.transaction():
+            delete_query = rejection_reasons_table.delete()
+            if reasons:
+                delete_query = delete_query.where(rejection_reasons_table.c.id.notin_(list(reasons)))
+            await db.execute(query=delete_query)
+            if reasons:
+                query = insert(rejection_reasons_table).values([
+                    {'id': id_, 'name': name, 'updated_at': now} for id_, name in reasons.items()
+                ])
+                await db.execute(query=query.on_conflict_do_update(
+                    index_elements=[rejection_reasons_table.c.id],
+                    set_={'name': query.excluded.name, 'updated_at': query.excluded.updated_at},
+                ))
+
+
+@db_query
+async def has_pending_operations(applicant_id: int) -> bool:
+    query = pending_operations_table.select().where(
+        (pending_operations_table.c.applicant_id == applicant_id)
+        & pending_operations_table.c.next_attempt_at.isnot(None)
+    ).limit(1)
+    async with connect_database() as db:
+        return await db.fetch_one(query=query) is not None
+
+
+@db_query
+async def count_dead_operations() -> int:
+    """
+    Число операций, которые больше не повторяются (next_attempt_at пуст)
+    """
+    query = sqlalchemy.select([sqlalchemy.func.count()]).select_from(pending_operations_table).where(
+        pending_operations_table.c.next_attempt_at.is_(None)
+    )
+    async with connect_database() as db:
+        return int(await db.fetch_val(query=query))
+
+
+@db_query
+async def add_pending_operation(
+    applicant_id: int,
+    operation: str,
+    payload: str,
+    next_attempt_at: dt.datetime,
+    attempts: int = 0,
+    last_error: t.Optional[str] = None,
+) -> None:
+    query = pending_operations_table.insert().values(
+        applicant_id=applicant_id,
+        operation=operation,
+        payload=payload,
+        attempts=attempts,
+        next_attempt_at=next_attempt_at,
+        last_error=last_error,
+        created_at=dt.datetime.utcnow(),
+    )
+    async with connect_database() as db:
+        await db.execute(query=query)
+
+
+@db_query
+async def claim_pending_operations(limit: int, lease: dt.timedelta) -> t.List[t.Any]:
+    """
+    Забирает до limit готовых к повтору операций, по одной первой операции на кандидата,
+    и откладывает их на lease, чтобы их не забрала другая реплика
+    """
+    query = (
+        'UPDATE pending_operations SET next_attempt_at = :lease_until '
+        'WHERE id IN ('
+        '  SELECT p.id FROM pending_operations p '
+        '  WHERE p.next_attempt_at <= :now AND NOT EXISTS ('
+        '    SELECT 1 FROM pending_operations e '
+        '    WHERE e.applicant_id = p.applicant_id AND e.id < p.id AND e.next_attempt_at IS NOT NULL'
+        '  ) '
+        '  ORDER BY p.id LIMIT :limit FOR UPDATE SKIP LOCKED'
+        ') RETURNING *'
+    )
+    now = dt.datetime.utcnow()
+    async with connect_database() as db:
+        rows = await db.fetch_all(query=query, values={'now': now, 'lease_until': now + lease, 'limit': limit})
+    return sorted(rows, key=lambda row: row['id'])
+
+
+@db_query
+async def delete_pending_operation(id_: int) -> None:
+    query = pending_operations_table.delete().where(pending_operations_table.c.id == id_)
+    async with connect_database() as db:
+        await db.execute(query=query)
+
+
+@db_query
+async def reschedule_pending_operation(
+    id_: int, attempts: int, next_attempt_at: t.Optional[dt.datetime], last_error: str
+) -> None:
+    query = pending_operations_table.update().where(pending_operations_table.c.id == id_).values(
+        attempts=attempts, next_attempt_at=next_attempt_at, last_error=last_error
+    )
+    async with connect_database() as db:
+        await db.execute(query=query)
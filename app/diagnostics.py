@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import typing as t
+from collections import Counter
+
+from prometheus_client import Histogram
+
+import settings
+from app.metrics import HANDLER_SECONDS
+from app.metrics import HUNTFLOW_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+Stack = t.Tuple[str, ...]
+
+
+def wall_time(histogram: Histogram) -> t.List[t.Tuple[str, float, float]]:
+    """
+    Суммарное время и число вызовов по значениям меток гистограммы, по убыванию времени
+    """
+    totals: t.Dict[str, t.List[float]] = {}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            if not sample.name.endswith(('_sum', '_count')):
+                continue
+            key = ' '.join(str(value) for value in sample.labels.values())
+            total = totals.setdefault(key, [0.0, 0.0])
+            total[0 if sample.name.endswith('_sum') else 1] += sample.value
+    return sorted(((key, seconds, count) for key, (seconds, count) in totals.items()), key=lambda row: -row[1])
+
+
+class Diagnostics:
+    """
+    Режим диагностики event loop: включает debug-режим loop, при котором asyncio пишет в лог колбэки
+    дольше slow_callback_duration, и поток, который каждые sample_interval секунд снимает стек потока loop.
+    Отчёт (dump) содержит самые частые стеки и время по обработчикам шины и эндпоинтам Huntflow
+    """
+
+    def __init__(
+        self,
+        slow_callback_duration: float,
+        sample_interval: float,
+        max_stacks: int,
+        stack_depth: int,
+        dump_path: t.Optional[str] = None,
+    ):
+        self.slow_callback_duration = slow_callback_duration
+        self.sample_interval = sample_interval
+        self.max_stacks = max_stacks
+        self.stack_depth = stack_depth
+        self.dump_path = dump_path
+        self.samples: t.Counter[Stack] = Counter()
+        self.total_samples = 0
+        self.dropped_samples = 0
+        self._loop: t.Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: t.Optional[int] = None
+        self._sampler: t.Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._sampler is not None
+
+    def enable(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Вызывается из потока, в котором работает loop
+        """
+        if self.enabled:
+            return
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.slow_callback_duration
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name='diagnostics-sampler', daemon=True)
+        self._sampler.start()
+        logger.warning('Diagnostics enabled')
+
+    def disable(self) -> None:
+        if self._sampler is None:
+            return
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+        if self._loop is not None:
+            self._loop.set_debug(False)
+        logger.warning('Diagnostics disabled')
+
+    def toggle(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable(loop)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.samples.clear()
+            self.total_samples = 0
+            self.dropped_samples = 0
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(t.cast(int, self._loop_thread_id))
+            if frame is None:
+                continue
+            stack = tuple(
+                f'{summary.filename}:{summary.lineno} {summary.name}'
+                for summary in traceback.extract_stack(frame)[-self.stack_depth:]
+            )
+            del frame
+            with self._lock:
+                self.total_samples += 1
+                if stack in self.samples or len(self.samples) < self.max_stacks:
+                    self.samples[stack] += 1
+                else:
+                    self.dropped_samples += 1
+
+    def report(self, top: int = 10) -> str:
+        with self._lock:
+            samples = self.samples.most_common(top)
+            total = self.total_samples
+            dropped = self.dropped_samples
+
+        lines = [f'Loop stack samples: {total} (dropped: {dropped}, interval: {self.sample_interval}s)']
+        for stack, count in samples:
+            lines.append(f'{count / total:7.1%} {count}')
+            lines.extend(f'        {frame}' for frame in stack)
+
+        for title, histogram in (('Bus handlers', HANDLER_SECONDS), ('Huntflow endpoints', HUNTFLOW_REQUEST_SECONDS)):
+            lines.append(f'{title} wall time:')
+            for key, seconds, calls in wall_time(histogram):
+                average = seconds / calls * 1000 if calls else 0
+                lines.append(f'    {key}: {seconds:.3f}s in {int(calls)} calls, avg {average:.1f}ms')
+
+        if self._loop is not None:
+            lines.append(f'Pending tasks: {len(asyncio.all_tasks(self._loop))}')
+        return '\n'.join(lines)
+
+    def dump(self) -> None:
+        report = self.report()
+        logger.warning('Diagnostics report:\n%s', report)
+        if self.dump_path:
+            with open(self.dump_path, 'a') as f:
+                f.write(f'--- {time.strftime("%Y-%m-%d %H:%M:%S")}\n{report}\n')
+
+
+diagnostics: Diagnostics = Diagnostics(
+    slow_callback_duration=settings.DIAGNOSTICS_SLOW_CALLBACK_SECONDS,
+    sample_interval=settings.DIAGNOSTICS_SAMPLE_INTERVAL,
+    max_stacks=settings.DIAGNOSTICS_MAX_STACKS,
+    stack_depth=settings.DIAGNOSTICS_STACK_DEPTH,
+    dump_path=settings.DIAGNOSTICS_DUMP_PATH,
+)
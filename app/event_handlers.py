@@ -1,7 +1,9 @@
+import json
 import logging
 import typing as t
+from collections import OrderedDict
 
-from chassis.clients.ie_intranet_ad import Client as IntranetADClient
+from bus import Event
 
 import settings
 from app import database
@@ -15,10 +17,12 @@ from app.bus_service import ApplicantSecurityCheckFinished
 from app.bus_service import ApplicantSecurityCheckPrepared
 from app.bus_service import ApplicantSelfRejected
 from app.bus_service import VacancyRecommendationSubmitted
-from app.bus_service import listener
-from app.bus_service import sender
+from app.file_cache import uploaded_files_cache
+from app.handler_executor import handlers
 from app.huntflow_api import huntflow_client
+from app.intranet_ad import ad_client
 from app.models import SyncError
+from app.retry_queue import retry_queue
 from app.utlis import files as files_utils
 from app.utlis import huntflow as huntflow_utils
 
@@ -37,15 +41,15 @@ def render_resume(candidate: VacancyRecommendationSubmitted, email: t.Optional[s
     )
 
 
-ad_client: IntranetADClient = IntranetADClient(
-    url=settings.IE_INTRANET_AD_API, token=settings.TOKEN
-)
+@handlers.on(VacancyRecommendationSubmitted, ordered_by='id')
+async def push_candidate_to_huntflow(event: VacancyRecommendationSubmitted) -> None:
+    await retry_queue.run_or_schedule(event.id, 'push_candidate', event.json())
 
 
-@listener.on(VacancyRecommendationSubmitted)
-async def push_candidate_to_huntflow(event: VacancyRecommendationSubmitted) -> None:
-    users = ad_client.get_users(event.inviter.username)
-    email = users[0].mail if len(users) == 1 else ''
+@retry_queue.operation('push_candidate')
+async def push_candidate(payload: str) -> None:
+    event = VacancyRecommendationSubmitted.parse_raw(payload)
+    email = await ad_client.get_user_email(event.inviter.username)
     resume_str = render_resume(event, email)
     applicant = await database.get_applicant_by_id(event.id)
 
@@ -86,8 +90,8 @@ async def _push_candidate(
     }
 
     if event.files and len(event.files) > 0:
-        files = await huntflow_client.account_upload_files(
-            await files_utils.download_files(event.files)
+        files = await files_utils.relay_files(
+            event.files, huntflow_client.account_upload_file, cache=uploaded_files_cache
         )
         candidate['files_ids'] = applicant['files_ids'] = huntflow_utils.get_files_ids(files)
         logger.info('uploaded files %s', str(candidate['files_ids']))
@@ -97,79 +101,102 @@ async def _push_candidate(
     applicant['applicant_id'] = applicant_id
 
 
-@listener.on(ApplicantSecurityCheckCreated)
-async def push_arms_url_to_huntflow(event: ApplicantSecurityCheckCreated) -> None:
-    applicant = await database.get_applicant_by_id(event.id)
+async def push_status_comment(id_: int, comment: str) -> None:
+    await retry_queue.run_or_schedule(id_, 'push_status_comment', json.dumps({'id': id_, 'comment': comment}))
+
+
+@retry_queue.operation('push_status_comment')
+async def _push_status_comment(payload: str) -> None:
+    data = json.loads(payload)
+    applicant = await database.get_applicant_by_id(data['id'])
     await huntflow_client.push_candidate_to_vacancy(
         applicant['applicant_id'],
         status_id=settings.HUNTFLOW_SECURITY_CHECK_STATUS,
-        comment=f'Создана ссылка на проверку в СБ: {event.arms_url}'
+        comment=data['comment']
     )
 
 
-@listener.on(ApplicantSecurityCheckFilled)
+@handlers.on(ApplicantSecurityCheckCreated, ordered_by='id')
+async def push_arms_url_to_huntflow(event: ApplicantSecurityCheckCreated) -> None:
+    await push_status_comment(event.id, f'Создана ссылка на проверку в СБ: {event.arms_url}')
+
+
+@handlers.on(ApplicantSecurityCheckFilled, ordered_by='id')
 async def push_arms_filled(event: ApplicantSecurityCheckFilled) -> None:
-    applicant = await database.get_applicant_by_id(event.id)
-    await huntflow_client.push_candidate_to_vacancy(
-        applicant['applicant_id'],
-        status_id=settings.HUNTFLOW_SECURITY_CHECK_STATUS,
-        comment='Анкета СБ заполнена'
-    )
+    await push_status_comment(event.id, 'Анкета СБ заполнена')
 
 
-@listener.on(ApplicantSecurityCheckFailed)
+@handlers.on(ApplicantSecurityCheckFailed, ordered_by='id')
 async def push_arms_failed(event: ApplicantSecurityCheckFailed) -> None:
-    applicant = await database.get_applicant_by_id(event.id)
-    await huntflow_client.push_candidate_to_vacancy(
-        applicant['applicant_id'],
-        status_id=settings.HUNTFLOW_SECURITY_CHECK_STATUS,
-        comment='Анкета СБ была заполнена некорректно.'
-    )
+    await push_status_comment(event.id, 'Анкета СБ была заполнена некорректно.')
 
 
-@listener.on(ApplicantSecurityCheckFinished)
+@handlers.on(ApplicantSecurityCheckFinished, ordered_by='id')
 async def push_arms_finished(event: ApplicantSecurityCheckFinished) -> None:
-    applicant = await database.get_applicant_by_id(event.id)
     status_description = {
         'done': 'Проверка завершена.',
         'refuse': 'Отказ от проверки.'
     }
-    await huntflow_client.push_candidate_to_vacancy(
-        applicant['applicant_id'],
-        status_id=settings.HUNTFLOW_SECURITY_CHECK_STATUS,
-        comment=f'Проверка СБ завершена со статусом: {status_description.get(event.status, event.status)}'
+    await push_status_comment(
+        event.id, f'Проверка СБ завершена со статусом: {status_description.get(event.status, event.status)}'
     )
 
 
-async def send_applicant_security_check_prepared_event(id_: int, hf_id: int) -> None:
-    await sender.send(ApplicantSecurityCheckPrepared(id=id_))
+async def build_applicant_security_check_prepared_event(id_: int, hf_id: int) -> Event:
+    return ApplicantSecurityCheckPrepared(id=id_)
 
 
 class RejectedCandidateStatusError(Exception):
     pass
 
 
-async def send_applicant_rejected_event(id_: int, hf_id: int) -> None:
+_rejection_events: 't.OrderedDict[t.Tuple[int, int, int], t.Type[Event]]' = OrderedDict()
+
+
+async def classify_rejection(hf_id: int, log: t.Any) -> t.Type[Event]:
+    """
+    Определяет событие отказа по записи лога. Результат запоминается по (кандидат, запись лога, причина)
+    """
+    key = (hf_id, log.get('id'), log['rejection_reason'])
+    if key in _rejection_events:
+        _rejection_events.move_to_end(key)
+        return _rejection_events[key]
+
+    comment = (await huntflow_client.get_rejection_reason(log['rejection_reason'])).lower()
+    event_cls: t.Type[Event]
+    if 'сам:' in comment:
+        event_cls = ApplicantSelfRejected
+    elif 'не прошел сб' in comment:
+        event_cls = ApplicantSBRejected
+    else:
+        event_cls = ApplicantRejected
+
+    if log.get('id') is not None:
+        _rejection_events[key] = event_cls
+        while len(_rejection_events) > settings.REJECTION_CLASSIFICATION_CACHE_SIZE:
+            _rejection_events.popitem(last=False)
+    return event_cls
+
+
+async def build_applicant_rejected_event(id_: int, hf_id: int) -> t.Optional[Event]:
     logs = await huntflow_client.get_applicant_log(hf_id)
-    async for log in logs:
-        if log.get('status') != settings.HUNTFLOW_REJECTED_STATUS or not log.get('rejection_reason'):
-            continue
-
-        comment = (await huntflow_client.get_rejection_reason(log['rejection_reason'])).lower()
-        if 'сам:' in comment:
-            await sender.send(ApplicantSelfRejected(id=id_))
-        elif 'не прошел сб' in comment:
-            await sender.send(ApplicantSBRejected(id=id_))
-        else:
-            await sender.send(ApplicantRejected(id=id_))
-        return
+    try:
+        async for log in logs:
+            if log.get('status') != settings.HUNTFLOW_REJECTED_STATUS or not log.get('rejection_reason'):
+                continue
+
+            event_cls = await classify_rejection(hf_id, log)
+            return event_cls(id=id_)
+    finally:
+        await logs.aclose()
     applicant = await database.get_applicant_by_id(id_)
     last_sync_error = applicant.get('last_sync_error')
     await database.update_applicant(id_=id_, last_sync_error=SyncError.no_rejection_reason)
 
     if not last_sync_error or last_sync_error is not SyncError.no_rejection_reason:
         raise RejectedCandidateStatusError('Invalid rejected status for applicant %s', hf_id)
+    return None
 
 
-async def send_applicant_reserved_event(id_: int, hf_id: int) -> None:
-    await sender.send(ApplicantAlreadyRecommended(id=id_))
+async def build_applicant_reserved_event(id_: int, hf_id: int) -> Event:
+    return ApplicantAlreadyRecommended(id=id_)
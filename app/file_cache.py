@@ -0,0 +1,49 @@
+import datetime as dt
+import logging
+import typing as t
+
+import settings
+from app import database
+
+logger = logging.getLogger(__name__)
+
+
+class UploadedFilesCache:
+    """
+    Кэш уже загруженных в Huntflow файлов: ключ - url источника или sha256 содержимого, значение - id файла.
+    Запись живёт ttl с момента последнего использования
+    """
+
+    def __init__(self, ttl: dt.timedelta):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    async def get_by_url(self, url: str) -> t.Optional[t.Dict[str, t.Any]]:
+        return await self._get(f'url:{url}')
+
+    async def get_by_digest(self, sha256: str) -> t.Optional[t.Dict[str, t.Any]]:
+        return await self._get(f'sha256:{sha256}')
+
+    async def _get(self, key: str) -> t.Optional[t.Dict[str, t.Any]]:
+        uploaded_file = await database.get_uploaded_file(key, used_after=dt.datetime.utcnow() - self.ttl)
+        if uploaded_file is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_saved += uploaded_file['size']
+        logger.info('Reuse uploaded file %s for %s', uploaded_file['file_id'], key)
+        return {'id': uploaded_file['file_id']}
+
+    async def remember_url(self, url: str, file_id: int, size: int) -> None:
+        await database.save_uploaded_file([f'url:{url}'], file_id, size)
+
+    async def record_upload(self, url: str, sha256: str, file_id: int, size: int) -> None:
+        await database.save_uploaded_file([f'url:{url}', f'sha256:{sha256}'], file_id, size)
+
+    async def purge_expired(self) -> None:
+        await database.delete_uploaded_files(used_before=dt.datetime.utcnow() - self.ttl)
+
+
+uploaded_files_cache: UploadedFilesCache = UploadedFilesCache(dt.timedelta(days=settings.FILES_CACHE_TTL_DAYS))
@@ -0,0 +1,124 @@
+import asyncio
+import functools
+import typing as t
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from bus import Event
+from bus import Listener
+
+import settings
+from app.bus_service import listener
+from app.metrics import HANDLER_EVENTS
+from app.metrics import HANDLER_SECONDS
+from app.metrics import measure
+
+Handler = t.Callable[[t.Any], t.Awaitable[None]]
+
+
+class KeyedLock:
+    """
+    Набор FIFO-блокировок по ключу: задачи с одним ключом выполняются строго по очереди,
+    с разными - параллельно. Блокировка удаляется, когда её больше никто не ждёт
+    """
+
+    def __init__(self) -> None:
+        self._locks: t.Dict[t.Hashable, t.Tuple[asyncio.Lock, int]] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: t.Hashable) -> t.AsyncGenerator[None, None]:
+        lock, users = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class HandlerExecutor:
+    """
+    Регистрирует обработчики шины и ограничивает число одновременно выполняемых обработчиков:
+    всего не более concurrency и не более type_concurrency[имя события] для каждого типа события.
+    Приём сообщений ограничивает prefetch listener (APP_BUS_PREFETCH, по умолчанию равен concurrency):
+    пока все слоты заняты, шина не отдаёт новых сообщений, а ждут слота (waiting, queue_depth) только сообщения,
+    упёршиеся в лимит своего типа или в очередь кандидата.
+    Если задан ordered_by, события с одинаковым значением этого поля обрабатываются строго по очереди
+    """
+
+    def __init__(self, listener: Listener, concurrency: int, type_concurrency: t.Dict[str, int]):
+        self.listener = listener
+        self.concurrency = concurrency
+        self.type_concurrency = type_concurrency
+        self.waiting: t.Counter[str] = Counter()
+        self.in_flight: t.Counter[str] = Counter()
+        self._semaphore: t.Optional[asyncio.Semaphore] = None
+        self._type_semaphores: t.Dict[str, asyncio.Semaphore] = {}
+        self.lanes = KeyedLock()
+
+    def on(self, event_cls: t.Type[Event], ordered_by: t.Optional[str] = None) -> t.Callable[[Handler], Handler]:
+        def decorator(func: Handler) -> Handler:
+            @functools.wraps(func)
+            async def handle(event: t.Any) -> None:
+                async with self.slot(event_cls.__name__):
+                    with measure(HANDLER_SECONDS, HANDLER_EVENTS, event_type=event_cls.__name__):
+                        await func(event)
+
+            @functools.wraps(func)
+            async def wrapper(event: t.Any) -> None:
+                if ordered_by is None:
+                    await handle(event)
+                    return
+                async with self.lanes(getattr(event, ordered_by)):
+                    await handle(event)
+
+            self.listener.on(event_cls)(wrapper)
+            return wrapper
+
+        return decorator
+
+    @asynccontextmanager
+    async def slot(self, event_type: str) -> t.AsyncGenerator[None, None]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        if event_type not in self._type_semaphores:
+            self._type_semaphores[event_type] = asyncio.Semaphore(
+                self.type_concurrency.get(event_type, self.concurrency)
+            )
+
+        self.waiting[event_type] += 1
+        acquired = False
+        try:
+            async with self._type_semaphores[event_type], self._semaphore:
+                self.waiting[event_type] -= 1
+                self.in_flight[event_type] += 1
+                acquired = True
+                try:
+                    yield
+                finally:
+                    self.in_flight[event_type] -= 1
+        finally:
+            if not acquired:
+                self.waiting[event_type] -= 1
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(self.waiting.values())
+
+    @property
+    def in_flight_total(self) -> int:
+        return sum(self.in_flight.values())
+
+
+handlers: HandlerExecutor = HandlerExecutor(
+    listener, settings.BUS_HANDLER_CONCURRENCY, settings.BUS_HANDLER_TYPE_CONCURRENCY
+)
@@ -1,15 +1,31 @@
 import asyncio
 import logging
+import time
 import typing as t
+from collections import deque
 from urllib.parse import urljoin
 
 import aiohttp
+from tenacity import RetryCallState
 from tenacity import before_sleep_log
 from tenacity import retry
+from tenacity import retry_if_exception
 from tenacity import stop_after_attempt
-from tenacity import wait_fixed
+from tenacity import wait_random_exponential
+from tenacity.wait import wait_base
 
 import settings
+from app.metrics import HUNTFLOW_REQUEST_SECONDS
+from app.metrics import HUNTFLOW_REQUESTS
+from app.metrics import HUNTFLOW_RETRIES
+from app.metrics import endpoint_label
+from app.metrics import measure
+from app.utlis import transport
+from app.utlis.fast_json import JSONDecoder
+from app.utlis.fast_json import get_decoder
+from app.utlis.rate_limit import TokenBucket
+from app.utlis.rate_limit import parse_retry_after
+from app.utlis.records import record_type
 
 logger = logging.getLogger(__name__)
 
@@ -26,39 +42,106 @@ class UnknownRejectionReason(Exception):
     pass
 
 
-class AsyncClient:
-    PAGES_PROCESSING_AMOUNT = 5
+def is_retryable_error(exc: BaseException) -> bool:
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+class wait_retry_after(wait_base):  # type: ignore
+    """
+    Ждёт столько, сколько указано в Retry-After ответа, но не больше max_wait, иначе - по fallback стратегии
+    """
+
+    def __init__(self, fallback: wait_base, max_wait: float):
+        self.fallback = fallback
+        self.max_wait = max_wait
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        exc = retry_state.outcome.exception() if retry_state.outcome else None
+        if isinstance(exc, aiohttp.ClientResponseError) and exc.headers:
+            delay = parse_retry_after(exc.headers.get('Retry-After'))
+            if delay is not None:
+                return min(delay, self.max_wait)
+        return float(self.fallback(retry_state))
+
+
+_log_retry = before_sleep_log(logger, logging.DEBUG)
+
 
-    _rejection_reasons: t.Dict[int, str] = {}
+def before_retry(retry_state: RetryCallState) -> None:
+    HUNTFLOW_RETRIES.labels(method=retry_state.fn.__name__).inc()
+    _log_retry(retry_state)
 
-    def __init__(self, base_url: str, token: str):
+
+huntflow_retry = retry(
+    retry=retry_if_exception(is_retryable_error),
+    stop=stop_after_attempt(settings.HUNTFLOW_RETRY_ATTEMPTS),
+    wait=wait_retry_after(
+        wait_random_exponential(multiplier=1, max=settings.HUNTFLOW_RETRY_MAX_WAIT), settings.HUNTFLOW_RETRY_MAX_WAIT
+    ),
+    before_sleep=before_retry,
+)
+
+
+class AsyncClient:
+    PAGES_PROCESSING_AMOUNT = settings.HUNTFLOW_PAGES_WINDOW
+    REJECTION_REASONS_TTL = settings.HUNTFLOW_REJECTION_REASONS_TTL
+
+    def __init__(self, base_url: str, token: str, json_loads: t.Optional[JSONDecoder] = None):
         self.base_url = base_url
         self.token = token
+        self.json_loads = json_loads or get_decoder(settings.HUNTFLOW_JSON_DECODER)
+        self._rejection_reasons: t.Dict[int, str] = {}
+        self._rejection_reasons_updated_at = 0.0
+        # id причин отказа, которых не нашлось в справочнике, и время проверки
+        self._missing_rejection_reasons: t.Dict[int, float] = {}
+        self._rejection_reasons_refresh: t.Optional['asyncio.Future[t.Dict[int, str]]'] = None
         self._session: t.Optional[aiohttp.ClientSession] = None
+        self.pages_fetched = 0
+        self.read_limiter = TokenBucket(settings.HUNTFLOW_READ_RATE, settings.HUNTFLOW_READ_BURST)
+        self.write_limiter = TokenBucket(settings.HUNTFLOW_WRITE_RATE, settings.HUNTFLOW_WRITE_BURST)
 
     @property
     def session(self) -> aiohttp.ClientSession:
-        if self._session is None:
-            self._session = aiohttp.ClientSession(
+        if self._session is None or self._session.closed:
+            self._session = transport.create_session(
                 headers={'Authorization': 'Bearer ' + self.token},
             )
         return self._session
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2), before_sleep=before_sleep_log(logger, logging.DEBUG))
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+    @staticmethod
+    def _raise_for_status(response: aiohttp.ClientResponse, limiter: TokenBucket) -> None:
+        if response.status == 429:
+            delay = parse_retry_after(response.headers.get('Retry-After')) or settings.HUNTFLOW_RETRY_MAX_WAIT
+            limiter.block(min(delay, settings.HUNTFLOW_RETRY_MAX_WAIT))
+        response.raise_for_status()
+
+    @huntflow_retry
     async def request_get(self, path: str, params: t.Optional[t.Any] = None) -> t.Any:
         if params is None:
             params = {}
         url = urljoin(self.base_url, path)
-        async with self.session.get(url, params=params) as response:
-            response.raise_for_status()
-            return await response.json()
+        await self.read_limiter.acquire()
+        with measure(HUNTFLOW_REQUEST_SECONDS, HUNTFLOW_REQUESTS, method='GET', endpoint=endpoint_label(path)):
+            async with self.session.get(url, params=params) as response:
+                self._raise_for_status(response, self.read_limiter)
+                return self.json_loads(await response.read())
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2), before_sleep=before_sleep_log(logger, logging.DEBUG))
     async def request_post(self, path: str, data: t.Optional[t.Dict[str, t.Any]] = None) -> t.Any:
+        """
+        Запрос выполняется один раз: повторы записей делает очередь app.retry_queue, не занимая слот обработчика
+        """
         url = urljoin(self.base_url, path)
-        async with self.session.post(url, json=data) as response:
-            response.raise_for_status()
-            return await response.json()
+        await self.write_limiter.acquire()
+        with measure(HUNTFLOW_REQUEST_SECONDS, HUNTFLOW_REQUESTS, method='POST', endpoint=endpoint_label(path)):
+            async with self.session.post(url, json=data) as response:
+                self._raise_for_status(response, self.write_limiter)
+                return self.json_loads(await response.read())
 
     async def push_candidate_to_vacancy(
         self,
@@ -117,62 +200,160 @@ class AsyncClient:
         logger.info('Pushed candidate %s %s, got id: %s', first_name, last_name, result_candidate['id'])
         return int(result_candidate['id'])
 
-    async def _request_pages(self, path: str, params: t.Optional[t.Any]) -> t.Any:
+    async def _request_pages(
+        self,
+        path: str,
+        params: t.Optional[t.Any],
+        window: t.Optional[int] = None,
+        ordered: bool = True,
+    ) -> t.AsyncGenerator[t.Any, None]:
+        """
+        Постранично запрашивает данные скользящим окном: одновременно выполняется не более window запросов.
+        Страницы отдаются по мере загрузки - по порядку (ordered=True) или в порядке готовности.
+        Если потребитель прекращает итерацию, незавершённые запросы отменяются
+        """
         if params is None:
             params = {}
+        if window is None:
+            window = self.PAGES_PROCESSING_AMOUNT
         data = await self.request_get(path, params)
+        self.pages_fetched += 1
         yield data
-        semaphore = asyncio.Semaphore(self.PAGES_PROCESSING_AMOUNT)
-
-        async def request_semaphore(ind: int) -> t.Any:
-            async with semaphore:
-                return await self.request_get(path, dict({'page': ind}, **params))  # type:ignore
 
-        tasks = [request_semaphore(i) for i in range(2, data.get('total', 1) + 1)]
+        pages = iter(range(2, data.get('total', 1) + 1))
+        tasks: t.Set['asyncio.Future[t.Any]'] = set()
+        queue: t.Deque['asyncio.Future[t.Any]'] = deque()
 
-        for result in await asyncio.gather(*tasks):
-            yield result
+        def request_next_page() -> None:
+            page = next(pages, None)
+            if page is not None:
+                task = asyncio.ensure_future(self.request_get(path, dict({'page': page}, **params)))
+                tasks.add(task)
+                queue.append(task)
 
-    async def request_batch(self, path: str, params: t.Optional[t.Any] = None) -> t.Any:
-        async for data in self._request_pages(path, params):
-            for item in data.get('items', []):
+        try:
+            for _ in range(window):
+                request_next_page()
+            while tasks:
+                if ordered:
+                    task = queue.popleft()
+                    await asyncio.wait([task])
+                else:
+                    done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    task = done.pop()
+                    queue.remove(task)
+                tasks.discard(task)
+                request_next_page()
+                self.pages_fetched += 1
+                yield task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def request_batch(
+        self,
+        path: str,
+        params: t.Optional[t.Any] = None,
+        ordered: bool = True,
+        window: t.Optional[int] = None,
+        fields: t.Optional[t.Sequence[str]] = None,
+    ) -> t.AsyncGenerator[t.Any, None]:
+        """
+        Элементы всех страниц. Если заданы fields, вместо словарей отдаются компактные записи только с этими полями
+        """
+        record_cls = record_type(fields) if fields else None
+        async for data in self._request_pages(path, params, window=window, ordered=ordered):
+            items = data.get('items', [])
+            if record_cls is not None:
+                items = [record_cls.from_dict(item) for item in items]
+            for item in items:
                 yield item
 
     async def get_vacancy_status_applicants(self, vacancy_id: int, status_id: int) -> t.Any:
         return self.request_batch(
             f'/account/{settings.HUNTFLOW_ACCOUNT}/applicants',
-            {'vacancy': vacancy_id, 'status': status_id}
+            {'vacancy': vacancy_id, 'status': status_id},
+            ordered=False,
+            fields=('id',),
         )
 
     async def get_applicant_log(self, applicant_id: int) -> t.Any:
+        """
+        Лог кандидата от новых записей к старым. Страницы запрашиваются по одной (с упреждением на одну),
+        поэтому поиск последней подходящей записи не выкачивает весь лог
+        """
         return self.request_batch(
-            f'/account/{settings.HUNTFLOW_ACCOUNT}/applicants/{applicant_id}/log'
+            f'/account/{settings.HUNTFLOW_ACCOUNT}/applicants/{applicant_id}/log',
+            window=1,
+            fields=('id', 'status', 'rejection_reason'),
         )
 
+    def load_rejection_reasons(self, reasons: t.Dict[int, str], updated_at: float) -> None:
+        self._rejection_reasons = reasons
+        self._rejection_reasons_updated_at = updated_at
+        for id_ in reasons:
+            self._missing_rejection_reasons.pop(id_, None)
+
+    async def _fetch_rejection_reasons(self) -> t.Dict[int, str]:
+        reasons = {
+            reason['id']: reason['name'] async for reason in
+            self.request_batch(f'/account/{settings.HUNTFLOW_ACCOUNT}/rejection_reasons')
+        }
+        self.load_rejection_reasons(reasons, time.time())
+        return reasons
+
+    def _start_rejection_reasons_refresh(self) -> 'asyncio.Future[t.Dict[int, str]]':
+        if self._rejection_reasons_refresh is None:
+            self._rejection_reasons_refresh = asyncio.ensure_future(self._fetch_rejection_reasons())
+
+            def reset(_: t.Any) -> None:
+                self._rejection_reasons_refresh = None
+
+            self._rejection_reasons_refresh.add_done_callback(reset)
+        return self._rejection_reasons_refresh
+
+    @staticmethod
+    def _log_refresh_error(future: 'asyncio.Future[t.Dict[int, str]]') -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('Failed to refresh rejection reasons', exc_info=future.exception())
+
+    async def refresh_rejection_reasons(self) -> t.Dict[int, str]:
+        """
+        Перезапрашивает справочник причин отказа. Одновременные вызовы выполняют один запрос
+        """
+        return await asyncio.shield(self._start_rejection_reasons_refresh())
+
     async def get_rejection_reason(self, id_: int) -> t.Any:
         if not self._rejection_reasons:
-            self._rejection_reasons = {
-                reason['id']: reason['name'] async for reason in
-                self.request_batch(f'/account/{settings.HUNTFLOW_ACCOUNT}/rejection_reasons')
-            }
+            await self.refresh_rejection_reasons()
+        elif id_ not in self._rejection_reasons:
+            # справочник перезапрашивается из-за неизвестной причины не чаще раза в REJECTION_REASONS_TTL
+            checked_at = self._missing_rejection_reasons.get(id_)
+            if checked_at is None or time.time() - checked_at > self.REJECTION_REASONS_TTL:
+                logger.info('Unknown rejection reason %s, refreshing rejection reasons', id_)
+                await self.refresh_rejection_reasons()
+                if id_ not in self._rejection_reasons:
+                    self._missing_rejection_reasons[id_] = time.time()
+        elif time.time() - self._rejection_reasons_updated_at > self.REJECTION_REASONS_TTL:
+            # обновление в фоне: справочник хранится в клиенте, ошибка только пишется в лог
+            self._start_rejection_reasons_refresh().add_done_callback(self._log_refresh_error)
 
         if id_ not in self._rejection_reasons:
             raise UnknownRejectionReason(id_)
 
         return self._rejection_reasons[id_]
 
-    async def account_upload_files(self, files: t.List[bytes]) -> t.List[t.Dict[str, t.Any]]:
-        return [
-            resp for resp in await asyncio.gather(
-                *[self.account_upload_file(file) for file in files]
-            )
-        ]
-
-    async def account_upload_file(self, file: bytes) -> t.Any:
+    async def account_upload_file(
+        self, file: t.Union[bytes, t.IO[bytes], t.AsyncIterable[bytes]], filename: str = 'file'
+    ) -> t.Any:
         url = urljoin(self.base_url, f'/account/{settings.HUNTFLOW_ACCOUNT}/upload')
+        form = aiohttp.FormData()
+        form.add_field('file', file, filename=filename)
+        await self.write_limiter.acquire()
         try:
-            async with self.session.post(url, data={'file': file}) as resp:
-                return await resp.json()
+            with measure(HUNTFLOW_REQUEST_SECONDS, HUNTFLOW_REQUESTS, method='POST', endpoint='/account/{id}/upload'):
+                async with self.session.post(url, data=form) as resp:
+                    return self.json_loads(await resp.read())
         except Exception as e:
             raise UploadFileException(e)
 
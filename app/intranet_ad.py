@@ -0,0 +1,117 @@
+import asyncio
+import functools
+import logging
+import time
+import typing as t
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from chassis.clients.ie_intranet_ad import Client as IntranetADClient
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncADClient:
+    """
+    Асинхронная обёртка над синхронным клиентом Intranet AD.
+    Запросы выполняются в ограниченном пуле потоков, чтобы медленный ответ AD не блокировал event loop.
+    Почты пользователей кэшируются (LRU + TTL), неизвестные пользователи кэшируются на negative_cache_ttl,
+    одновременные запросы одного и того же пользователя склеиваются в один запрос к AD.
+    При таймауте поднимается asyncio.TimeoutError, чтобы операция ушла в очередь повторов. Поток с зависшим
+    запросом нельзя прервать, поэтому повторный запрос того же пользователя ждёт уже запущенный вызов,
+    а если все потоки заняты зависшими вызовами, новые запросы сразу завершаются таймаутом
+    """
+
+    def __init__(
+        self,
+        client: IntranetADClient,
+        max_workers: int,
+        timeout: float,
+        cache_size: int = 1024,
+        cache_ttl: float = 3600,
+        negative_cache_ttl: float = 300,
+    ):
+        self.client = client
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.negative_cache_ttl = negative_cache_ttl
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.coalesced_lookups = 0
+        self.max_workers = max_workers
+        self._calls: t.Dict[str, t.Tuple[float, 'asyncio.Future[t.List[t.Any]]']] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='intranet-ad')
+        self._emails: 't.OrderedDict[str, t.Tuple[float, str]]' = OrderedDict()
+        self._lookups: t.Dict[str, 'asyncio.Future[str]'] = {}
+
+    async def get_users(self, username: str) -> t.List[t.Any]:
+        now = time.monotonic()
+        started_at, call = self._calls.get(username, (now, None))
+        if call is None:
+            stuck = sum(1 for call_started_at, _ in self._calls.values() if now - call_started_at >= self.timeout)
+            if stuck >= self.max_workers:
+                raise asyncio.TimeoutError(f'All {stuck} Intranet AD workers are stuck')
+            call = asyncio.get_event_loop().run_in_executor(self._executor, self.client.get_users, username)
+            self._calls[username] = (now, call)
+            call.add_done_callback(functools.partial(self._call_done, username))
+        # вызов в потоке не прерывается по таймауту, shield не даёт wait_for отменить future этого вызова
+        users: t.List[t.Any] = await asyncio.wait_for(
+            asyncio.shield(call), timeout=max(self.timeout - (now - started_at), 0)
+        )
+        return users
+
+    def _call_done(self, username: str, call: 'asyncio.Future[t.List[t.Any]]') -> None:
+        self._calls.pop(username, None)
+        if not call.cancelled():
+            call.exception()  # ошибка уже передана ожидавшим вызов, если они дождались его
+
+    async def get_user_email(self, username: str) -> str:
+        cached = self._emails.get(username)
+        if cached is not None and cached[0] > time.monotonic():
+            self._emails.move_to_end(username)
+            self.cache_hits += 1
+            return cached[1]
+
+        lookup = self._lookups.get(username)
+        if lookup is None:
+            self.cache_misses += 1
+            lookup = asyncio.ensure_future(self._lookup_email(username))
+            self._lookups[username] = lookup
+            lookup.add_done_callback(lambda _: self._lookups.pop(username, None))
+        else:
+            self.coalesced_lookups += 1
+        return await asyncio.shield(lookup)
+
+    async def _lookup_email(self, username: str) -> str:
+        try:
+            users = await self.get_users(username)
+        except asyncio.TimeoutError:
+            logger.warning('Intranet AD lookup for user %s timed out', username)
+            raise
+
+        email = users[0].mail if len(users) == 1 else ''
+        ttl = self.cache_ttl if email else self.negative_cache_ttl
+        self._emails[username] = (time.monotonic() + ttl, email)
+        self._emails.move_to_end(username)
+        while len(self._emails) > self.cache_size:
+            self._emails.popitem(last=False)
+        return email
+
+    def clear_cache(self) -> None:
+        self._emails.clear()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+ad_client: AsyncADClient = AsyncADClient(
+    IntranetADClient(url=settings.IE_INTRANET_AD_API, token=settings.TOKEN),
+    max_workers=settings.IE_INTRANET_AD_MAX_WORKERS,
+    timeout=settings.IE_INTRANET_AD_TIMEOUT,
+    cache_size=settings.IE_INTRANET_AD_CACHE_SIZE,
+    cache_ttl=settings.IE_INTRANET_AD_CACHE_TTL,
+    negative_cache_ttl=settings.IE_INTRANET_AD_NEGATIVE_CACHE_TTL,
+)
@@ -0,0 +1,63 @@
+import functools
+import logging
+import typing as t
+
+import asyncpg
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+F = t.TypeVar('F', bound=t.Callable[..., t.Awaitable[None]])
+
+
+class LeaderElection:
+    """
+    Выбор лидера среди реплик через advisory lock Postgres.
+    Блокировка держится на отдельном соединении: если реплика-лидер падает, соединение рвётся,
+    Postgres снимает блокировку, и на следующем запуске задачи её забирает другая реплика
+    """
+
+    def __init__(self, lock_id: int):
+        self.lock_id = lock_id
+        self._connection: t.Optional[asyncpg.Connection] = None
+        self.is_leader = False
+
+    async def acquire(self) -> bool:
+        if self._connection is not None and self._connection.is_closed():
+            logger.warning('Leader election connection lost')
+            self._connection = None
+            self.is_leader = False
+
+        try:
+            if self._connection is None:
+                self._connection = await asyncpg.connect(settings.DB_DSN)
+            if self.is_leader:
+                await self._connection.execute('SELECT 1')
+            else:
+                self.is_leader = await self._connection.fetchval('SELECT pg_try_advisory_lock($1)', self.lock_id)
+                if self.is_leader:
+                    logger.info('Became leader for lock %s', self.lock_id)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            logger.warning('Leader election failed: %s', e)
+            await self.close()
+        return self.is_leader
+
+    async def close(self) -> None:
+        connection, self._connection = self._connection, None
+        self.is_leader = False
+        if connection is not None and not connection.is_closed():
+            await connection.close()
+
+    def leader_only(self, func: F) -> F:
+        @functools.wraps(func)
+        async def wrapper(*args: t.Any, **kwargs: t.Any) -> None:
+            if not await self.acquire():
+                logger.debug('Not a leader, skip %s', func.__name__)
+                return
+            await func(*args, **kwargs)
+
+        return t.cast(F, wrapper)
+
+
+leader: LeaderElection = LeaderElection(settings.LEADER_LOCK_ID)
@@ -2,14 +2,28 @@ import asyncio
 import datetime
 import logging
 import signal
+import typing as t
 
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import settings
+from app import database
 from app.bus_service import listener
 from app.bus_service import sender
+from app.diagnostics import diagnostics
+from app.file_cache import uploaded_files_cache
 from app.huntflow_api import huntflow_client
+from app.intranet_ad import ad_client
+from app.leader import leader
+from app.outbox import outbox_relay
+from app.retry_queue import retry_queue
+from app.sync import load_rejection_reasons_snapshot
+from app.sync import refresh_rejection_reasons
 from app.sync import sync_applicant_vacancy_statuses
+from app.utlis import transport
+from app.web import start_web_server
+from app.web import webhook_available
 
 logger = logging.getLogger(__name__)
 
@@ -18,26 +32,66 @@ scheduler = AsyncIOScheduler()
 loop = asyncio.get_event_loop()
 
 
+async def close_http_clients() -> None:
+    await huntflow_client.close()
+    await transport.close()
+
+
 async def listen_bus_events() -> None:
+    web_runner: t.Optional[web.AppRunner] = None
+    relay_task: t.Optional[asyncio.Task[None]] = None
+    retry_task: t.Optional[asyncio.Task[None]] = None
+
     def stop_loop() -> None:
+        if relay_task is not None:
+            relay_task.cancel()
+        if retry_task is not None:
+            retry_task.cancel()
+        if web_runner is not None:
+            loop.create_task(web_runner.cleanup())
         loop.create_task(listener.stop())
         loop.create_task(sender.close())
-        loop.create_task(huntflow_client.session.close())
+        loop.create_task(close_http_clients())
+        loop.create_task(leader.close())
+        loop.create_task(database.close_pool())
+        ad_client.close()
+        diagnostics.disable()
 
     for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
         loop.add_signal_handler(sig, stop_loop)
+    # SIGUSR1 - записать отчёт диагностики в лог, SIGUSR2 - включить/выключить диагностику
+    loop.add_signal_handler(signal.SIGUSR1, diagnostics.dump)
+    loop.add_signal_handler(signal.SIGUSR2, diagnostics.toggle, loop)
+    if settings.DIAGNOSTICS_ENABLED:
+        diagnostics.enable(loop)
     await sender.connect()
+    relay_task = loop.create_task(outbox_relay.run())
+    retry_task = loop.create_task(retry_queue.run())
+    if webhook_available() or settings.METRICS_ENABLED:
+        web_runner = await start_web_server()
     await listener.listen()
 
 if __name__ == '__main__':
+    loop.run_until_complete(database.connect_pool())
+    loop.run_until_complete(load_rejection_reasons_snapshot())
     scheduler.start()
     scheduler.add_job(
-        sync_applicant_vacancy_statuses,
+        leader.leader_only(sync_applicant_vacancy_statuses),
         'interval',
-        minutes=settings.APP_SCHEDULER_INTERVAL_MINUTES,
+        minutes=(
+            settings.APP_SCHEDULER_RECONCILE_INTERVAL_MINUTES if webhook_available()
+            else settings.APP_SCHEDULER_INTERVAL_MINUTES
+        ),
         next_run_time=datetime.datetime.now(),
         max_instances=1,
     )
+    scheduler.add_job(
+        refresh_rejection_reasons,
+        'interval',
+        seconds=settings.HUNTFLOW_REJECTION_REASONS_TTL,
+        max_instances=1,
+    )
+    scheduler.add_job(leader.leader_only(uploaded_files_cache.purge_expired), 'interval', hours=24, max_instances=1)
     loop.create_task(listen_bus_events())
     try:
         loop.run_forever()
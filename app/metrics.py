@@ -0,0 +1,83 @@
+import functools
+import re
+import time
+import typing as t
+from contextlib import contextmanager
+
+from prometheus_client import Counter
+from prometheus_client import Histogram
+
+F = t.TypeVar('F', bound=t.Callable[..., t.Awaitable[t.Any]])
+
+HUNTFLOW_REQUEST_SECONDS = Histogram(
+    'huntflow_request_seconds', 'Время запроса к Huntflow', ['method', 'endpoint']
+)
+HUNTFLOW_REQUESTS = Counter(
+    'huntflow_requests_total', 'Запросы к Huntflow', ['method', 'endpoint', 'result']
+)
+HUNTFLOW_RETRIES = Counter(
+    'huntflow_retries_total', 'Повторы запросов к Huntflow', ['method']
+)
+HANDLER_SECONDS = Histogram(
+    'bus_handler_seconds', 'Время обработки события шины', ['event_type']
+)
+HANDLER_EVENTS = Counter(
+    'bus_handler_events_total', 'Обработанные события шины', ['event_type', 'result']
+)
+DB_QUERY_SECONDS = Histogram(
+    'db_query_seconds', 'Время выполнения функции app.database', ['function']
+)
+DB_QUERIES = Counter(
+    'db_queries_total', 'Вызовы функций app.database', ['function', 'result']
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    'db_pool_wait_seconds', 'Ожидание свободного соединения в пуле'
+)
+SYNC_SECONDS = Histogram(
+    'sync_seconds', 'Длительность синхронизации статусов', [], buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200)
+)
+SYNC_RUNS = Counter(
+    'sync_runs_total', 'Запуски синхронизации статусов', ['result']
+)
+SYNC_PAGES = Histogram(
+    'sync_pages_fetched', 'Страниц Huntflow загружено за синхронизацию', [], buckets=(1, 5, 10, 25, 50, 100, 250, 500)
+)
+
+_ID_RE = re.compile(r'/\d+')
+
+
+def endpoint_label(path: str) -> str:
+    """
+    Заменяет идентификаторы в пути на {id}, чтобы число значений метки не росло
+    """
+    return _ID_RE.sub('/{id}', path)
+
+
+@contextmanager
+def measure(histogram: Histogram, counter: Counter, **labels: str) -> t.Iterator[None]:
+    started = time.perf_counter()
+    result = 'ok'
+    try:
+        yield
+    except BaseException:
+        result = 'error'
+        raise
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(time.perf_counter() - started)
+        counter.labels(result=result, **labels).inc()
+
+
+def instrument(histogram: Histogram, counter: Counter, **labels: str) -> t.Callable[[F], F]:
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        async def wrapper(*args: t.Any, **kwargs: t.Any) -> t.Any:
+            with measure(histogram, counter, **labels):
+                return await func(*args, **kwargs)
+
+        return t.cast(F, wrapper)
+
+    return decorator
+
+
+def db_query(func: F) -> F:
+    return instrument(DB_QUERY_SECONDS, DB_QUERIES, function=func.__name__)(func)
@@ -16,5 +16,53 @@ applicants_table = sqlalchemy.Table(
     sqlalchemy.Column('applicant_id', sqlalchemy.Integer, unique=True),
     sqlalchemy.Column('status_id', sqlalchemy.Integer),
     sqlalchemy.Column('files_ids', sqlalchemy.ARRAY(sqlalchemy.Integer)),
-    sqlalchemy.Column('last_sync_error', sqlalchemy.Enum(SyncError), nullable=True),
+    sqlalchemy.Column('last_sync_error', sqlalchemy.Enum(SyncError, name='sync_error'), nullable=True),
+)
+
+sync_cursors_table = sqlalchemy.Table(
+    'sync_cursors',
+    metadata,
+    sqlalchemy.Column('status_id', sqlalchemy.Integer, primary_key=True, autoincrement=False),
+    sqlalchemy.Column('synced_at', sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Column('full_synced_at', sqlalchemy.DateTime, nullable=True),
+)
+
+uploaded_files_table = sqlalchemy.Table(
+    'uploaded_files',
+    metadata,
+    sqlalchemy.Column('key', sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column('file_id', sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column('size', sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column('created_at', sqlalchemy.DateTime, nullable=False),
+    sqlalchemy.Column('last_used_at', sqlalchemy.DateTime, nullable=False, index=True),
+)
+
+rejection_reasons_table = sqlalchemy.Table(
+    'rejection_reasons',
+    metadata,
+    sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True, autoincrement=False),
+    sqlalchemy.Column('name', sqlalchemy.String, nullable=False),
+    sqlalchemy.Column('updated_at', sqlalchemy.DateTime, nullable=False),
+)
+
+outbox_table = sqlalchemy.Table(
+    'outbox',
+    metadata,
+    sqlalchemy.Column('id', sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column('event_type', sqlalchemy.String, nullable=False),
+    sqlalchemy.Column('payload', sqlalchemy.Text, nullable=False),
+    sqlalchemy.Column('created_at', sqlalchemy.DateTime, nullable=False),
+)
+
+pending_operations_table = sqlalchemy.Table(
+    'pending_operations',
+    metadata,
+    sqlalchemy.Column('id', sqlalchemy.BigInteger, primary_key=True),
+    sqlalchemy.Column('applicant_id', sqlalchemy.Integer, nullable=False, index=True),
+    sqlalchemy.Column('operation', sqlalchemy.String, nullable=False),
+    sqlalchemy.Column('payload', sqlalchemy.Text, nullable=False),
+    sqlalchemy.Column('attempts', sqlalchemy.Integer, nullable=False, default=0),
+    sqlalchemy.Column('next_attempt_at', sqlalchemy.DateTime, nullable=True),
+    sqlalchemy.Column('last_error', sqlalchemy.Text, nullable=True),
+    sqlalchemy.Column('created_at', sqlalchemy.DateTime, nullable=False),
 )
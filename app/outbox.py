@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import typing as t
+
+from bus import Event
+
+import settings
+from app.bus_service import ApplicantAlreadyRecommended
+from app.bus_service import ApplicantRejected
+from app.bus_service import ApplicantSBRejected
+from app.bus_service import ApplicantSecurityCheckPrepared
+from app.bus_service import ApplicantSelfRejected
+from app.bus_service import sender
+from app.database import connect_database
+from app.models import outbox_table
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES: t.Dict[str, t.Type[Event]] = {
+    event_cls.__name__: event_cls for event_cls in (
+        ApplicantSecurityCheckPrepared,
+        ApplicantRejected,
+        ApplicantSelfRejected,
+        ApplicantAlreadyRecommended,
+        ApplicantSBRejected,
+    )
+}
+
+
+class OutboxRelay:
+    """
+    Отправляет в шину события из таблицы outbox пачками по batch_size.
+    Пачка отправляется, как только набралось batch_size событий, но не позже чем через linger секунд.
+    Строки блокируются через FOR UPDATE SKIP LOCKED, поэтому relay может работать на нескольких репликах
+    """
+
+    def __init__(self, batch_size: int, linger: float):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.published = 0
+        self._pending = 0
+        self._wakeup: t.Optional[asyncio.Event] = None
+
+    def notify(self, count: int) -> None:
+        self._pending += count
+        if self._wakeup is not None and self._pending >= self.batch_size:
+            self._wakeup.set()
+
+    async def relay_pending(self) -> int:
+        query = (
+            outbox_table.select()
+            .order_by(outbox_table.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with connect_database() as db:
+            async with db.transaction():
+                rows = await db.fetch_all(query=query)
+                for row in rows:
+                    await sender.send(EVENT_TYPES[row['event_type']].parse_raw(row['payload']))
+                if rows:
+                    await db.execute(
+                        query=outbox_table.delete().where(outbox_table.c.id.in_([row['id'] for row in rows]))
+                    )
+        self._pending = max(self._pending - len(rows), 0)
+        self.published += len(rows)
+        return len(rows)
+
+    async def run(self) -> None:
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                while await self.relay_pending() == self.batch_size:
+                    pass
+            except Exception as e:
+                logger.exception(str(e))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.linger)
+            except asyncio.TimeoutError:
+                pass
+
+
+outbox_relay: OutboxRelay = OutboxRelay(settings.OUTBOX_BATCH_SIZE, settings.OUTBOX_LINGER_SECONDS)
@@ -0,0 +1,119 @@
+import asyncio
+import datetime as dt
+import logging
+import typing as t
+
+import settings
+from app import database
+from app.huntflow_api import UploadFileException
+from app.huntflow_api import is_retryable_error
+
+logger = logging.getLogger(__name__)
+
+Operation = t.Callable[[str], t.Awaitable[None]]
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """
+    Повторяются только временные ошибки: 429 и 5xx Huntflow, ошибки соединения и таймауты, ошибки загрузки файлов
+    """
+    return is_retryable_error(exc) or isinstance(exc, UploadFileException)
+
+
+class RetryQueue:
+    """
+    Хранимая в Postgres очередь повторов для операций с Huntflow.
+    Операция сначала выполняется сразу; при ошибке она сохраняется в pending_operations и повторяется
+    фоновым воркером с экспоненциальной задержкой. Операции одного кандидата выполняются строго по порядку:
+    пока у кандидата есть незавершённая операция, новые операции встают в очередь за ней.
+    В очередь попадают только ошибки, для которых retryable возвращает True, остальные сразу пробрасываются.
+    После max_attempts неудачных попыток или при неповторяемой ошибке во время повтора операция остаётся
+    в таблице с пустым next_attempt_at, их число - dead_operations
+    """
+
+    def __init__(
+        self,
+        base_delay: float,
+        max_delay: float,
+        max_attempts: int,
+        batch_size: int,
+        poll_interval: float,
+        retryable: t.Callable[[BaseException], bool] = is_retryable,
+    ):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retryable = retryable
+        self.dead_operations = 0
+        self._operations: t.Dict[str, Operation] = {}
+
+    def operation(self, name: str) -> t.Callable[[Operation], Operation]:
+        def decorator(func: Operation) -> Operation:
+            self._operations[name] = func
+            return func
+
+        return decorator
+
+    def get_delay(self, attempts: int) -> dt.timedelta:
+        return dt.timedelta(seconds=min(self.base_delay * 2 ** (attempts - 1), self.max_delay))
+
+    async def run_or_schedule(self, applicant_id: int, name: str, payload: str) -> None:
+        now = dt.datetime.utcnow()
+        if await database.has_pending_operations(applicant_id):
+            logger.info('Applicant %s has pending operations, %s is queued', applicant_id, name)
+            await database.add_pending_operation(applicant_id, name, payload, next_attempt_at=now)
+            return
+
+        try:
+            await self._operations[name](payload)
+        except Exception as e:
+            if not self.retryable(e):
+                raise
+            logger.exception('Operation %s for applicant %s failed, scheduled for retry', name, applicant_id)
+            await database.add_pending_operation(
+                applicant_id, name, payload, next_attempt_at=now + self.get_delay(1), attempts=1, last_error=str(e)
+            )
+
+    async def drain(self) -> int:
+        operations = await database.claim_pending_operations(
+            self.batch_size, lease=dt.timedelta(seconds=self.max_delay)
+        )
+        for operation in operations:
+            attempts = operation['attempts'] + 1
+            try:
+                await self._operations[operation['operation']](operation['payload'])
+            except Exception as e:
+                if not self.retryable(e) or attempts >= self.max_attempts:
+                    logger.exception(
+                        'Operation %s for applicant %s failed %s times, giving up',
+                        operation['operation'], operation['applicant_id'], attempts,
+                    )
+                    next_attempt_at = None
+                    self.dead_operations += 1
+                else:
+                    next_attempt_at = dt.datetime.utcnow() + self.get_delay(attempts)
+                await database.reschedule_pending_operation(operation['id'], attempts, next_attempt_at, str(e))
+            else:
+                await database.delete_pending_operation(operation['id'])
+        return len(operations)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                while await self.drain() == self.batch_size:
+                    pass
+                self.dead_operations = await database.count_dead_operations()
+            except Exception as e:
+                logger.exception(str(e))
+            await asyncio.sleep(self.poll_interval)
+
+
+retry_queue: RetryQueue = RetryQueue(
+    base_delay=settings.RETRY_QUEUE_BASE_DELAY,
+    max_delay=settings.RETRY_QUEUE_MAX_DELAY,
+    max_attempts=settings.RETRY_QUEUE_MAX_ATTEMPTS,
+    batch_size=settings.RETRY_QUEUE_BATCH_SIZE,
+    poll_interval=settings.RETRY_QUEUE_POLL_INTERVAL,
+)
@@ -1,53 +1,199 @@
+import asyncio
+import datetime as dt
 import logging
+import typing as t
 
-import pydantic
+from bus import Event
 
 import settings
-from app.database import get_all_applicants
-from app.database import update_applicant
-from app.event_handlers import send_applicant_rejected_event
-from app.event_handlers import send_applicant_reserved_event
-from app.event_handlers import send_applicant_security_check_prepared_event
+from app.applicant_index import applicant_index
+from app.database import applicants_cache
+from app.database import get_applicant_by_hf_id
+from app.database import get_rejection_reasons
+from app.database import get_sync_cursors
+from app.database import iterate_applicant_index_rows
+from app.database import save_rejection_reasons
+from app.database import save_sync_cursor
+from app.database import spawn
+from app.database import update_applicants_statuses
+from app.event_handlers import build_applicant_rejected_event
+from app.event_handlers import build_applicant_reserved_event
+from app.event_handlers import build_applicant_security_check_prepared_event
 from app.huntflow_api import huntflow_client
+from app.metrics import SYNC_PAGES
+from app.metrics import SYNC_RUNS
+from app.metrics import SYNC_SECONDS
+from app.metrics import instrument
+from app.models import SyncError
+from app.outbox import outbox_relay
 
 logger = logging.getLogger(__name__)
 
-STATUS_EVENT_HANDLERS = [
-    (settings.HUNTFLOW_SECURITY_CHECK_STATUS, send_applicant_security_check_prepared_event),
-    (settings.HUNTFLOW_REJECTED_STATUS, send_applicant_rejected_event),
-    (settings.HUNTFLOW_RESERVE_STATUS, send_applicant_reserved_event)
+StatusEventSender = t.Callable[[int, int], t.Awaitable[t.Optional[Event]]]
+# id кандидата в Huntflow, id кандидата, текущий статус, новый статус, построитель события
+SyncTask = t.Tuple[int, int, t.Optional[int], int, StatusEventSender]
+
+STATUS_EVENT_HANDLERS: t.List[t.Tuple[int, StatusEventSender]] = [
+    (settings.HUNTFLOW_SECURITY_CHECK_STATUS, build_applicant_security_check_prepared_event),
+    (settings.HUNTFLOW_REJECTED_STATUS, build_applicant_rejected_event),
+    (settings.HUNTFLOW_RESERVE_STATUS, build_applicant_reserved_event)
 ]
 
 
-class ApplicantStatus(pydantic.BaseModel):
-    id: int
-    status_id: int
+def _is_full_sync_due(cursor: t.Any, now: dt.datetime) -> bool:
+    if cursor is None or cursor['full_synced_at'] is None:
+        return True
+    return bool(now - cursor['full_synced_at'] >= dt.timedelta(minutes=settings.SYNC_FULL_RESCAN_MINUTES))
+
+
+async def refresh_applicant_index(full: bool) -> None:
+    """
+    Перестраивает индекс кандидатов из базы, если ему нельзя доверять.
+    Изменения других реплик приходят только через NOTIFY, поэтому с ним полный индекс живёт между запусками
+    и перестраивается раз в APP_SYNC_INDEX_REBUILD_MINUTES. Без NOTIFY индекс перестраивается на каждом запуске,
+    но для инкрементального запуска (full=False) в него читаются только кандидаты не в терминальных статусах,
+    как и раньше: это меньше памяти, зато строки терминальных кандидатов приходится читать заново при полной сверке
+    """
+    max_age = settings.SYNC_INDEX_REBUILD_MINUTES * 60
+    if applicants_cache.listening and applicant_index.complete and applicant_index.is_fresh(max_age):
+        return
+    complete = full or applicants_cache.listening
+    applicant_index.begin_rebuild()
+    try:
+        async for row in iterate_applicant_index_rows(() if complete else settings.HUNTFLOW_TERMINAL_STATUSES):
+            applicant_index.add_row(row['id'], row['applicant_id'], row['status_id'])
+    except BaseException:
+        applicant_index.cancel_rebuild()
+        raise
+    applicant_index.finish_rebuild(complete)
+    logger.info('Rebuilt applicant index: %s applicants (complete: %s)', len(applicant_index), complete)
 
 
+@instrument(SYNC_SECONDS, SYNC_RUNS)
 async def sync_applicant_vacancy_statuses() -> None:
-    applicants = await get_all_applicants()
-    applicants_by_hf_id = {
-        a['applicant_id']: ApplicantStatus(
-            id=a['id'],
-            status_id=a['status_id'],
-        )
-        for a in applicants
+    """
+    Инкрементальная синхронизация: кандидаты в терминальных статусах (HUNTFLOW_TERMINAL_STATUSES)
+    не сверяются, а статус, в который не может перейти ни один из оставшихся кандидатов, не запрашивается.
+    Раз в SYNC_FULL_RESCAN_MINUTES каждый статус сверяется полностью.
+    Статусы запрашиваются параллельно, найденные кандидаты обрабатываются SYNC_CONCURRENCY воркерами,
+    новые статусы вместе с событиями для шины (outbox) записываются в базу пачками по SYNC_UPDATE_BATCH_SIZE
+    """
+    now = dt.datetime.utcnow()
+    pages_fetched = huntflow_client.pages_fetched
+    cursors = await get_sync_cursors()
+    full_sync_statuses = {
+        status for status, _ in STATUS_EVENT_HANDLERS if _is_full_sync_due(cursors.get(status), now)
     }
+    await refresh_applicant_index(full=bool(full_sync_statuses))
 
-    for status, applicant_status_sender in STATUS_EVENT_HANDLERS:
-        logger.info('Sync applicants with status %s', status)
+    queues: t.List['asyncio.Queue[SyncTask]'] = [
+        asyncio.Queue(maxsize=settings.SYNC_QUEUE_SIZE) for _ in range(settings.SYNC_CONCURRENCY)
+    ]
+
+    async def scan_status(status: int, applicant_status_sender: StatusEventSender, is_full_sync: bool) -> None:
+        logger.info('Sync applicants with status %s (full: %s)', status, is_full_sync)
         checked_applicants = await huntflow_client.get_vacancy_status_applicants(
             settings.HUNTFLOW_REFERRAL_VACANCY,
             status
         )
         async for applicant in checked_applicants:
             applicant_id = applicant['id']
-            if applicant_id not in applicants_by_hf_id:
+            indexed = applicant_index.get(applicant_id)
+            if indexed is None:
+                continue
+            id_, status_id = indexed
+            if not is_full_sync and status_id in settings.HUNTFLOW_TERMINAL_STATUSES:
                 continue
+            # события одного кандидата всегда попадают в одну очередь и обрабатываются по порядку
+            await queues[id_ % len(queues)].put((applicant_id, id_, status_id, status, applicant_status_sender))
+
+    changes: t.List[t.Tuple[int, t.Optional[int], t.Optional[SyncError]]] = []
+    events: t.List[Event] = []
+
+    async def flush_changes() -> None:
+        batch, batch_events = changes[:], events[:]
+        changes.clear()
+        events.clear()
+        try:
+            updated = await update_applicants_statuses(batch, batch_events)
+            outbox_relay.notify(sum(1 for event in batch_events if getattr(event, 'id', None) in updated))
+        except Exception as e:
+            # статусы в индексе уже обновлены, поэтому на следующем запуске индекс перестраивается из базы
+            applicant_index.invalidate()
+            logger.exception(str(e))
+
+    async def worker(queue: 'asyncio.Queue[SyncTask]') -> None:
+        while True:
+            applicant_id, id_, status_id, status, applicant_status_sender = await queue.get()
             try:
-                applicant_status: ApplicantStatus = applicants_by_hf_id[applicant['id']]
-                if applicant_status.status_id != status:
-                    await applicant_status_sender(applicant_status.id, applicant_id)
-                    await update_applicant(applicant_status.id, status_id=status)
+                if status_id != status:
+                    event = await applicant_status_sender(id_, applicant_id)
+                    applicant_index.apply({'id': id_, 'status_id': status})
+                    changes.append((id_, status, None))
+                    if event is not None:
+                        events.append(event)
+                    if len(changes) >= settings.SYNC_UPDATE_BATCH_SIZE:
+                        await flush_changes()
             except Exception as e:
                 logger.exception(str(e))
+            finally:
+                queue.task_done()
+
+    scans: t.List[t.Tuple[int, StatusEventSender, bool]] = []
+    for status, applicant_status_sender in STATUS_EVENT_HANDLERS:
+        is_full_sync = status in full_sync_statuses
+        if not is_full_sync and not any(
+            status_id != status and status_id not in settings.HUNTFLOW_TERMINAL_STATUSES
+            for status_id in applicant_index.statuses_in_huntflow()
+        ):
+            logger.info('Skip sync applicants with status %s: nothing to compare', status)
+            await save_sync_cursor(status, synced_at=now)
+            continue
+        scans.append((status, applicant_status_sender, is_full_sync))
+
+    # у каждого воркера и сканирования своё соединение с базой, иначе все они работают через соединение родителя
+    workers = [spawn(worker(queue)) for queue in queues]
+    try:
+        results = await asyncio.gather(*[spawn(scan_status(*scan)) for scan in scans], return_exceptions=True)
+        await asyncio.gather(*[queue.join() for queue in queues])
+    finally:
+        for worker_task in workers:
+            worker_task.cancel()
+        await flush_changes()
+
+    for (status, _, is_full_sync), result in zip(scans, results):
+        if not isinstance(result, BaseException):
+            await save_sync_cursor(status, synced_at=now, full_synced_at=now if is_full_sync else None)
+    SYNC_PAGES.observe(huntflow_client.pages_fetched - pages_fetched)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def load_rejection_reasons_snapshot() -> None:
+    reasons, updated_at = await get_rejection_reasons()
+    if reasons and updated_at is not None:
+        huntflow_client.load_rejection_reasons(reasons, updated_at.replace(tzinfo=dt.timezone.utc).timestamp())
+        logger.info('Loaded %s rejection reasons from snapshot of %s', len(reasons), updated_at)
+
+
+async def refresh_rejection_reasons() -> None:
+    reasons = await huntflow_client.refresh_rejection_reasons()
+    await save_rejection_reasons(reasons)
+
+
+async def apply_applicant_status(hf_id: int, status: int) -> bool:
+    """
+    Обрабатывает смену статуса одного кандидата (например, из вебхука Huntflow).
+    Возвращает True, если статус изменился
+    """
+    applicant_status_sender = dict(STATUS_EVENT_HANDLERS).get(status)
+    if applicant_status_sender is None:
+        return False
+    applicant = await get_applicant_by_hf_id(hf_id)
+    if applicant is None or applicant['status_id'] == status:
+        return False
+    event = await applicant_status_sender(applicant['id'], hf_id)
+    updated = await update_applicants_statuses([(applicant['id'], status, None)], [event] if event is not None else [])
+    outbox_relay.notify(1 if updated and event is not None else 0)
+    return bool(updated)
@@ -0,0 +1,25 @@
+import json
+import typing as t
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+JSONDecoder = t.Callable[[t.Union[bytes, str]], t.Any]
+
+
+def get_decoder(name: str) -> JSONDecoder:
+    """
+    Возвращает функцию разбора JSON: 'json' - стандартная библиотека, 'orjson' - orjson,
+    'auto' - orjson, если он установлен (extra fast-json), иначе стандартная библиотека
+    """
+    if name == 'json':
+        return json.loads
+    if name in ('orjson', 'auto') and orjson is not None:
+        return t.cast(JSONDecoder, orjson.loads)
+    if name == 'auto':
+        return json.loads
+    if name == 'orjson':
+        raise ImportError('orjson is not installed, install the fast-json extra')
+    raise ValueError(f'Unknown JSON decoder {name}')
@@ -1,21 +1,104 @@
 import asyncio
+import hashlib
+import tempfile
 import typing as t
+from posixpath import basename
+from urllib.parse import urlparse
 
 import aiohttp
 
+import settings
+from app.utlis import transport
 
-async def download_file(url: str, session: aiohttp.ClientSession) -> bytes:
-    resp = await session.get(url)
-    if resp.status == 200:
-        return await resp.read()
+if t.TYPE_CHECKING:
+    from app.file_cache import UploadedFilesCache
 
-    raise FileExistsError('Exception while downloading file from $s', url)
+FileUploader = t.Callable[[t.Any, str], t.Awaitable[t.Dict[str, t.Any]]]
 
 
-async def download_files(urls: t.List[str]) -> t.List[bytes]:
-    async with aiohttp.ClientSession() as session:
-        return [
-            resp for resp in await asyncio.gather(
-                *[download_file(url, session) for url in urls]
-            )
-        ]
+class FileTooLargeError(Exception):
+    pass
+
+
+def get_filename(url: str) -> str:
+    return basename(urlparse(url).path) or 'file'
+
+
+class FileChunks:
+    """
+    Итератор по частям тела ответа, считающий размер и sha256 переданных данных
+    """
+
+    def __init__(self, resp: aiohttp.ClientResponse, url: str):
+        self.resp = resp
+        self.url = url
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def __aiter__(self) -> t.AsyncIterator[bytes]:
+        return self._iter_chunks()
+
+    async def _iter_chunks(self) -> t.AsyncGenerator[bytes, None]:
+        async for chunk in self.resp.content.iter_chunked(settings.FILES_CHUNK_SIZE):
+            self.size += len(chunk)
+            if self.size > settings.FILES_MAX_SIZE:
+                raise FileTooLargeError('File %s exceeds %s bytes', self.url, settings.FILES_MAX_SIZE)
+            self.sha256.update(chunk)
+            yield chunk
+
+
+async def relay_file(
+    url: str,
+    session: aiohttp.ClientSession,
+    upload: FileUploader,
+    cache: t.Optional['UploadedFilesCache'] = None,
+) -> t.Dict[str, t.Any]:
+    """
+    Передаёт файл из url в upload по частям, не загружая его в память целиком.
+    Если включён FILES_SPOOL_TO_DISK (по умолчанию), файл сначала сохраняется во временный файл:
+    при загрузке известен Content-Length, а sha256 содержимого известен до загрузки.
+    Если передан cache, уже загруженные файлы повторно не загружаются: по url - всегда,
+    по содержимому - только с FILES_SPOOL_TO_DISK, без него файл передаётся потоком и sha256 известен уже после загрузки
+    """
+    if cache is not None:
+        cached = await cache.get_by_url(url)
+        if cached is not None:
+            return cached
+
+    async with session.get(url) as resp:
+        if resp.status != 200:
+            raise FileExistsError('Exception while downloading file from %s', url)
+        if resp.content_length is not None and resp.content_length > settings.FILES_MAX_SIZE:
+            raise FileTooLargeError('File %s exceeds %s bytes', url, settings.FILES_MAX_SIZE)
+
+        chunks = FileChunks(resp, url)
+        if not settings.FILES_SPOOL_TO_DISK:
+            result = await upload(chunks, get_filename(url))
+        else:
+            with tempfile.TemporaryFile() as file:
+                async for chunk in chunks:
+                    file.write(chunk)
+                if cache is not None:
+                    cached = await cache.get_by_digest(chunks.sha256.hexdigest())
+                    if cached is not None:
+                        await cache.remember_url(url, cached['id'], chunks.size)
+                        return cached
+                file.seek(0)
+                result = await upload(file, get_filename(url))
+
+    if cache is not None and result.get('id'):
+        await cache.record_upload(url, chunks.sha256.hexdigest(), result['id'], chunks.size)
+    return result
+
+
+async def relay_files(
+    urls: t.List[str], upload: FileUploader, cache: t.Optional['UploadedFilesCache'] = None
+) -> t.List[t.Dict[str, t.Any]]:
+    semaphore = asyncio.Semaphore(settings.FILES_MAX_CONCURRENT_TRANSFERS)
+    session = transport.get_session()
+
+    async def relay(url: str) -> t.Dict[str, t.Any]:
+        async with semaphore:
+            return await relay_file(url, session, upload, cache)
+
+    return list(await asyncio.gather(*[relay(url) for url in urls]))
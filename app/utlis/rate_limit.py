@@ -0,0 +1,62 @@
+import asyncio
+import email.utils
+import time
+import typing as t
+
+
+def parse_retry_after(value: t.Optional[str]) -> t.Optional[float]:
+    """
+    Разбирает заголовок Retry-After: число секунд или HTTP-дата
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов: rate токенов в секунду, не более capacity токенов в запасе.
+    block() приостанавливает выдачу токенов, например на время из Retry-After
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f'TokenBucket needs rate > 0 and capacity >= 1, got rate={rate}, capacity={capacity}')
+        self.rate = rate
+        self.capacity = capacity
+        self.throttled_seconds = 0.0
+        self.throttled_requests = 0
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def block(self, seconds: float) -> None:
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        started_at = time.monotonic()
+        throttled = False
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self._blocked_until and self._tokens >= 1:
+                self._tokens -= 1
+                break
+            throttled = True
+            await asyncio.sleep(max(self._blocked_until - now, (1 - self._tokens) / self.rate))
+
+        if throttled:
+            self.throttled_seconds += time.monotonic() - started_at
+            self.throttled_requests += 1
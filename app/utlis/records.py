@@ -0,0 +1,52 @@
+import typing as t
+
+
+class Record:
+    """
+    Компактная запись с фиксированным набором полей (__slots__) вместо словаря ответа API.
+    Поддерживает чтение как у словаря: record['id'] и record.get('id')
+    """
+
+    __slots__: t.Tuple[str, ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: t.Dict[str, t.Any]) -> 'Record':
+        record = cls.__new__(cls)
+        for field in cls.__slots__:
+            setattr(record, field, data.get(field))
+        return record
+
+    def __getitem__(self, key: str) -> t.Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: t.Any = None) -> t.Any:
+        if key not in self.__slots__:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Record) or other.__slots__ != self.__slots__:
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{field}={getattr(self, field)!r}' for field in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+_record_types: t.Dict[t.Tuple[str, ...], t.Type[Record]] = {}
+
+
+def record_type(fields: t.Sequence[str]) -> t.Type[Record]:
+    """
+    Класс записи с полями fields. Для одинакового набора полей возвращается один и тот же класс
+    """
+    key = tuple(fields)
+    if key not in _record_types:
+        _record_types[key] = t.cast(
+            t.Type[Record], type(f'Record_{"_".join(key)}', (Record,), {'__slots__': key})
+        )
+    return _record_types[key]
@@ -0,0 +1,56 @@
+import typing as t
+
+import aiohttp
+
+import settings
+
+_connector: t.Optional[aiohttp.TCPConnector] = None
+_session: t.Optional[aiohttp.ClientSession] = None
+
+
+def get_connector() -> aiohttp.TCPConnector:
+    """
+    Общий для всех http-клиентов сервиса пул соединений
+    """
+    global _connector
+    if _connector is None or _connector.closed:
+        _connector = aiohttp.TCPConnector(
+            limit=settings.HTTP_POOL_SIZE,
+            limit_per_host=settings.HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=settings.HTTP_DNS_CACHE_TTL,
+        )
+    return _connector
+
+
+def get_timeout() -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(
+        total=settings.HTTP_TOTAL_TIMEOUT,
+        connect=settings.HTTP_CONNECT_TIMEOUT,
+        sock_read=settings.HTTP_READ_TIMEOUT,
+    )
+
+
+def create_session(**kwargs: t.Any) -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(connector=get_connector(), connector_owner=False, timeout=get_timeout(), **kwargs)
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Общая сессия без авторизации, например для скачивания файлов
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = create_session()
+    return _session
+
+
+async def close() -> None:
+    global _connector, _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+    if _connector is not None:
+        await _connector.close()
+        _connector = None
@@ -0,0 +1,174 @@
+import hashlib
+import hmac
+import json
+import logging
+import time
+import typing as t
+from collections import OrderedDict
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import REGISTRY
+from prometheus_client import generate_latest
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.core import GaugeMetricFamily
+
+import settings
+from app import database
+from app.file_cache import uploaded_files_cache
+from app.handler_executor import handlers
+from app.huntflow_api import huntflow_client
+from app.intranet_ad import ad_client
+from app.outbox import outbox_relay
+from app.retry_queue import retry_queue
+from app.sync import apply_applicant_status
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryDeduplicator:
+    """
+    Помнит ключи доставленных вебхуков ttl секунд, не более size штук
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._seen: 't.OrderedDict[str, float]' = OrderedDict()
+
+    def seen(self, key: str) -> bool:
+        now = time.monotonic()
+        while self._seen and next(iter(self._seen.values())) < now:
+            self._seen.popitem(last=False)
+        if key in self._seen:
+            return True
+        self._seen[key] = now + self.ttl
+        while len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+        return False
+
+    def forget(self, key: str) -> None:
+        self._seen.pop(key, None)
+
+
+deliveries = DeliveryDeduplicator(settings.HUNTFLOW_WEBHOOK_DEDUP_SIZE, settings.HUNTFLOW_WEBHOOK_DEDUP_TTL)
+
+
+def webhook_available() -> bool:
+    """
+    Вебхук принимается, только если он включён и задан секрет для проверки подписи
+    """
+    return settings.HUNTFLOW_WEBHOOK_ENABLED and bool(settings.HUNTFLOW_WEBHOOK_SECRET)
+
+
+def verify_signature(body: bytes, signature: t.Optional[str]) -> bool:
+    if not settings.HUNTFLOW_WEBHOOK_SECRET:
+        return False
+    expected = hmac.new(settings.HUNTFLOW_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+async def huntflow_webhook(request: web.Request) -> web.Response:
+    body = await request.read()
+    if not verify_signature(body, request.headers.get('X-Huntflow-Signature')):
+        return web.Response(status=403, text='invalid signature')
+    if request.headers.get('X-Huntflow-Event') != 'APPLICANT':
+        return web.Response(text='ignored')
+
+    try:
+        event = json.loads(body).get('event') or {}
+        log = event.get('applicant_log') or {}
+        hf_id = (event.get('applicant') or {}).get('id')
+        status = (log.get('status') or {}).get('id')
+        vacancy = (log.get('vacancy') or {}).get('id')
+    except (ValueError, AttributeError):
+        return web.Response(status=400, text='invalid payload')
+    if hf_id is None or status is None or vacancy != settings.HUNTFLOW_REFERRAL_VACANCY:
+        return web.Response(text='ignored')
+
+    delivery_key = request.headers.get('X-Huntflow-Delivery') or f'{hf_id}:{log.get("id")}:{status}'
+    if deliveries.seen(delivery_key):
+        return web.Response(text='duplicate')
+
+    try:
+        await apply_applicant_status(hf_id, status)
+    except Exception as e:
+        deliveries.forget(delivery_key)
+        logger.exception(str(e))
+        return web.Response(status=500, text='error')
+    return web.Response(text='ok')
+
+
+class StatsCollector:
+    """
+    Отдаёт в /metrics счётчики, которые компоненты сервиса ведут сами
+    """
+
+    def collect(self) -> t.Iterator[t.Union[CounterMetricFamily, GaugeMetricFamily]]:
+        counters = [
+            ('intranet_ad_cache_hits', 'Попадания в кэш почт AD', ad_client.cache_hits),
+            ('intranet_ad_cache_misses', 'Промахи кэша почт AD', ad_client.cache_misses),
+            ('intranet_ad_coalesced_lookups', 'Запросы в AD, объединённые с уже выполняющимися',
+             ad_client.coalesced_lookups),
+            ('uploaded_files_cache_hits', 'Файлы, не загруженные повторно', uploaded_files_cache.hits),
+            ('uploaded_files_cache_misses', 'Файлы, загруженные в Huntflow', uploaded_files_cache.misses),
+            ('uploaded_files_cache_bytes_saved', 'Байт не загружено повторно', uploaded_files_cache.bytes_saved),
+            ('applicants_cache_hits', 'Попадания в кэш кандидатов', database.applicants_cache.hits),
+            ('applicants_cache_misses', 'Промахи кэша кандидатов', database.applicants_cache.misses),
+            ('outbox_published', 'События, отправленные из outbox', outbox_relay.published),
+            ('huntflow_pages_fetched', 'Загруженные страницы Huntflow', huntflow_client.pages_fetched),
+        ]
+        for name, documentation, value in counters:
+            yield CounterMetricFamily(name, documentation, value=value)
+
+        throttled_seconds = CounterMetricFamily(
+            'huntflow_throttled_seconds', 'Время ожидания лимитера Huntflow', labels=['limiter']
+        )
+        throttled_requests = CounterMetricFamily(
+            'huntflow_throttled_requests', 'Запросы, ожидавшие лимитер Huntflow', labels=['limiter']
+        )
+        for limiter_name, limiter in (('read', huntflow_client.read_limiter), ('write', huntflow_client.write_limiter)):
+            throttled_seconds.add_metric([limiter_name], limiter.throttled_seconds)
+            throttled_requests.add_metric([limiter_name], limiter.throttled_requests)
+        yield throttled_seconds
+        yield throttled_requests
+
+        waiting = GaugeMetricFamily('bus_handler_waiting', 'События, ожидающие слот обработчика', labels=['event_type'])
+        in_flight = GaugeMetricFamily('bus_handler_in_flight', 'Выполняющиеся обработчики', labels=['event_type'])
+        for event_type, count in handlers.waiting.items():
+            waiting.add_metric([event_type], count)
+        for event_type, count in handlers.in_flight.items():
+            in_flight.add_metric([event_type], count)
+        yield waiting
+        yield in_flight
+        yield GaugeMetricFamily('bus_handler_lanes', 'Кандидаты с очередью событий', value=len(handlers.lanes))
+        yield GaugeMetricFamily(
+            'retry_queue_dead_operations', 'Операции Huntflow, которые больше не повторяются',
+            value=retry_queue.dead_operations,
+        )
+
+
+REGISTRY.register(StatsCollector())
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    if settings.METRICS_ENABLED:
+        app.router.add_get('/metrics', metrics)
+    if webhook_available():
+        app.router.add_post('/webhooks/huntflow', huntflow_webhook)
+    elif settings.HUNTFLOW_WEBHOOK_ENABLED:
+        logger.error('APP_HUNTFLOW_WEBHOOK_SECRET is not set, Huntflow webhook is disabled')
+    return app
+
+
+async def start_web_server() -> web.AppRunner:
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    await web.TCPSite(runner, settings.WEB_HOST, settings.WEB_PORT).start()
+    logger.info('Listening on %s:%s', settings.WEB_HOST, settings.WEB_PORT)
+    return runner
@@ -0,0 +1,176 @@
+"""
+Нагрузочный бенчмарк сервиса на заглушках Huntflow, AD и шины.
+
+    python -m benchmarks --applicants 1000 --latency 0.02 --json result.json
+    python -m benchmarks --applicants 1000 --baseline result.json
+
+Работает с настоящим кодом обработчиков, клиента Huntflow и синхронизации и с базой из APP_DB_DSN.
+Таблицы базы пересоздаются, поэтому APP_DB_DSN должен указывать на одноразовую базу.
+Лимиты запросов к Huntflow берутся из настроек (APP_HUNTFLOW_READ_RATE, APP_HUNTFLOW_WRITE_RATE и т.д.)
+"""
+import argparse
+import asyncio
+import json
+import resource
+import time
+import typing as t
+
+import sqlalchemy
+
+import settings
+from app import database
+from app.bus_service import sender
+from app.huntflow_api import huntflow_client
+from app.intranet_ad import ad_client
+from app.models import applicants_table
+from app.models import metadata
+from app.outbox import outbox_relay
+from app.sync import STATUS_EVENT_HANDLERS
+from app.sync import sync_applicant_vacancy_statuses
+from app.utlis import transport
+from benchmarks.fake_bus import FakeADClient
+from benchmarks.fake_bus import FakeBus
+from benchmarks.fake_bus import generate_events
+from benchmarks.fake_huntflow import FakeHuntflow
+
+
+def percentile(values: t.List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_database() -> None:
+    engine = sqlalchemy.create_engine(settings.DB_DSN)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+
+
+async def bench_events(args: argparse.Namespace, huntflow: FakeHuntflow) -> t.Dict[str, float]:
+    events = generate_events(args.applicants, huntflow.url, files_per_applicant=args.files)
+    bus = FakeBus(prefetch=args.prefetch)
+    duration = await bus.replay(events)
+    return {
+        'events': len(events),
+        'events_failed': bus.failed,
+        'events_per_second': len(events) / duration,
+        'handler_p50_ms': percentile(bus.latencies, 0.5) * 1000,
+        'handler_p99_ms': percentile(bus.latencies, 0.99) * 1000,
+        'events_seconds': duration,
+    }
+
+
+async def bench_sync(args: argparse.Namespace, huntflow: FakeHuntflow) -> t.Dict[str, float]:
+    """
+    Кандидаты из базы раскладываются по статусам синхронизации поровну;
+    первый запуск находит новые статусы у всех кандидатов, второй - уже ничего не меняет
+    """
+    offset = 1_000_000
+    async with database.connect_database() as db:
+        await db.execute_many(
+            query=applicants_table.insert(),
+            values=[
+                {'id': offset + id_, 'applicant_id': offset + id_, 'status_id': settings.HUNTFLOW_CANDIDATE_INIT_STATUS}
+                for id_ in range(args.sync_applicants)
+            ],
+        )
+    database.applicants_cache.clear()
+    statuses = [status for status, _ in STATUS_EVENT_HANDLERS]
+    for ind, status in enumerate(statuses):
+        huntflow.set_status_applicants(
+            status, [offset + id_ for id_ in range(args.sync_applicants) if id_ % len(statuses) == ind]
+        )
+
+    result = {}
+    for run in ('sync_first_seconds', 'sync_repeat_seconds'):
+        async with database.connect_database() as db:
+            await db.execute(query='DELETE FROM sync_cursors')
+        started = time.perf_counter()
+        await sync_applicant_vacancy_statuses()
+        result[run] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    relayed = 0
+    while True:
+        count = await outbox_relay.relay_pending()
+        if not count:
+            break
+        relayed += count
+    result['outbox_relayed'] = relayed
+    result['outbox_relay_seconds'] = time.perf_counter() - started
+    return result
+
+
+async def run(args: argparse.Namespace) -> t.Dict[str, float]:
+    reset_database()
+    huntflow = FakeHuntflow(
+        latency=args.latency,
+        page_size=args.page_size,
+        throttle_every=args.throttle_every,
+        upload_latency=args.upload_latency,
+        file_size=args.file_size,
+    )
+    await huntflow.start()
+    huntflow_client.base_url = huntflow.url
+    ad_client.client = FakeADClient(latency=args.ad_latency)
+    bus = FakeBus(prefetch=args.prefetch)
+    sender.send = bus.send  # type: ignore
+    await database.connect_pool()
+    try:
+        result = await bench_events(args, huntflow)
+        result.update(await bench_sync(args, huntflow))
+    finally:
+        await huntflow_client.close()
+        await transport.close()
+        await database.close_pool()
+        await huntflow.close()
+        ad_client.close()
+
+    result['huntflow_requests'] = huntflow.requests
+    result['huntflow_throttled'] = huntflow.throttled
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def report(result: t.Dict[str, float], baseline: t.Optional[t.Dict[str, float]]) -> None:
+    for name, value in result.items():
+        line = f'{name:<24} {value:>14.2f}'
+        if baseline and baseline.get(name):
+            line += f'  ({(value - baseline[name]) / baseline[name] * 100:+.1f}% vs baseline)'
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Нагрузочный бенчмарк сервиса')
+    parser.add_argument('--applicants', type=int, default=500, help='кандидатов в проигрываемых событиях шины')
+    parser.add_argument('--sync-applicants', type=int, default=5000, help='кандидатов в базе для синхронизации')
+    parser.add_argument('--files', type=int, default=1, help='файлов у каждого рекомендованного кандидата')
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--prefetch', type=int, default=100, help='сообщений шины в работе одновременно')
+    parser.add_argument('--latency', type=float, default=0.01, help='задержка ответа Huntflow, с')
+    parser.add_argument('--upload-latency', type=float, default=0.05, help='задержка загрузки файла, с')
+    parser.add_argument('--ad-latency', type=float, default=0.05, help='задержка ответа AD, с')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--throttle-every', type=int, default=0, help='каждый N-й запрос к Huntflow получает 429')
+    parser.add_argument('--json', help='сохранить результат в файл')
+    parser.add_argument('--baseline', help='сравнить с результатом из файла')
+    args = parser.parse_args()
+
+    result = asyncio.get_event_loop().run_until_complete(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import asyncio
+import datetime as dt
+import time
+import typing as t
+from types import SimpleNamespace
+
+from bus import Event
+
+from app import event_handlers
+from app.bus_service import ApplicantSecurityCheckCreated
+from app.bus_service import ApplicantSecurityCheckFailed
+from app.bus_service import ApplicantSecurityCheckFilled
+from app.bus_service import ApplicantSecurityCheckFinished
+from app.bus_service import Inviter
+from app.bus_service import VacancyRecommendationSubmitted
+
+HANDLERS: t.Dict[t.Type[Event], t.Callable[[t.Any], t.Awaitable[None]]] = {
+    VacancyRecommendationSubmitted: event_handlers.push_candidate_to_huntflow,
+    ApplicantSecurityCheckCreated: event_handlers.push_arms_url_to_huntflow,
+    ApplicantSecurityCheckFilled: event_handlers.push_arms_filled,
+    ApplicantSecurityCheckFailed: event_handlers.push_arms_failed,
+    ApplicantSecurityCheckFinished: event_handlers.push_arms_finished,
+}
+
+
+class FakeADClient:
+    """
+    Синхронный клиент AD с задержкой latency, как у настоящего
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def get_users(self, username: str) -> t.List[t.Any]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [SimpleNamespace(mail=f'{username}@example.com')]
+
+
+def generate_events(applicants: int, files_url: str, files_per_applicant: int = 1) -> t.List[Event]:
+    """
+    Рекомендация кандидата и полная цепочка событий проверки СБ для каждого кандидата.
+    Цепочки разных кандидатов перемешаны, как в реальной шине
+    """
+    chains = []
+    for id_ in range(1, applicants + 1):
+        chains.append([
+            VacancyRecommendationSubmitted(
+                id=id_,
+                inviter=Inviter(first_name='Пётр', last_name='Петров', username=f'user{id_ % 50}'),
+                first_name='Иван',
+                last_name=f'Иванов {id_}',
+                phone='+79990000000',
+                city='Москва',
+                about='Хороший кандидат',
+                circle=None,
+                specialization='Разработчик',
+                is_notified=True,
+                files=[f'{files_url}files/{id_}-{ind}.pdf' for ind in range(files_per_applicant)],
+            ),
+            ApplicantSecurityCheckCreated(
+                id=id_, arms_id=str(id_), arms_url=f'https://arms/{id_}', arms_created_at=dt.datetime.now()
+            ),
+            ApplicantSecurityCheckFilled(id=id_),
+            ApplicantSecurityCheckFinished(id=id_, arms_id=str(id_), status='done'),
+        ])
+
+    events = []
+    for step in range(max((len(chain) for chain in chains), default=0)):
+        events.extend(chain[step] for chain in chains if step < len(chain))
+    return events
+
+
+class FakeBus:
+    """
+    Проигрывает события через зарегистрированные обработчики, держа в работе не более prefetch сообщений,
+    и замеряет время от получения сообщения до завершения обработчика
+    """
+
+    def __init__(self, prefetch: int):
+        self.prefetch = prefetch
+        self.latencies: t.List[float] = []
+        self.failed = 0
+        self.published: t.List[Event] = []
+
+    async def send(self, event: Event) -> None:
+        self.published.append(event)
+
+    async def replay(self, events: t.Iterable[Event]) -> float:
+        semaphore = asyncio.Semaphore(self.prefetch)
+
+        async def deliver(event: Event) -> None:
+            try:
+                started = time.perf_counter()
+                await HANDLERS[type(event)](event)
+                self.latencies.append(time.perf_counter() - started)
+            except Exception:
+                self.failed += 1
+            finally:
+                semaphore.release()
+
+        started = time.perf_counter()
+        tasks = []
+        for event in events:
+            await semaphore.acquire()
+            tasks.append(asyncio.ensure_future(deliver(event)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
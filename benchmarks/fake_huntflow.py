@@ -0,0 +1,124 @@
+import asyncio
+import itertools
+import os
+import typing as t
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import settings
+
+
+class FakeHuntflow:
+    """
+    Заглушка API Huntflow в том же процессе: отвечает на все запросы, которые делает AsyncClient.
+    latency - задержка каждого ответа в секундах, page_size - кандидатов на странице,
+    throttle_every - каждый N-й запрос получает 429 с Retry-After, upload_latency - задержка загрузки файла,
+    file_size - размер файлов, которые отдаются по /files/{name}
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        page_size: int = 100,
+        throttle_every: int = 0,
+        retry_after: float = 0.1,
+        upload_latency: float = 0.0,
+        file_size: int = 64 * 1024,
+        log_length: int = 5,
+    ):
+        self.latency = latency
+        self.page_size = page_size
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.upload_latency = upload_latency
+        self.file_size = file_size
+        self.log_length = log_length
+        self.statuses: t.Dict[int, t.List[int]] = {}
+        self.requests = 0
+        self.throttled = 0
+        self.uploads = 0
+        self._ids = itertools.count(1)
+        self._server: t.Optional[TestServer] = None
+
+    @property
+    def url(self) -> str:
+        assert self._server is not None
+        return str(self._server.make_url('/'))
+
+    def set_status_applicants(self, status_id: int, applicant_ids: t.List[int]) -> None:
+        self.statuses[status_id] = applicant_ids
+
+    @web.middleware
+    async def middleware(
+        self, request: web.Request, handler: t.Callable[[web.Request], t.Awaitable[web.StreamResponse]]
+    ) -> web.StreamResponse:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.throttle_every and self.requests % self.throttle_every == 0 and request.path.startswith('/account'):
+            self.throttled += 1
+            return web.json_response({}, status=429, headers={'Retry-After': str(self.retry_after)})
+        return await handler(request)
+
+    def _page(self, request: web.Request, items: t.List[t.Any]) -> web.Response:
+        page = int(request.query.get('page', 1))
+        total = max((len(items) + self.page_size - 1) // self.page_size, 1)
+        start = (page - 1) * self.page_size
+        return web.json_response({
+            'items': items[start:start + self.page_size],
+            'page': page,
+            'count': self.page_size,
+            'total': total,
+        })
+
+    async def applicants(self, request: web.Request) -> web.Response:
+        ids = self.statuses.get(int(request.query.get('status', 0)), [])
+        return self._page(request, [{'id': id_, 'first_name': 'Иван', 'last_name': 'Иванов'} for id_ in ids])
+
+    async def create_applicant(self, request: web.Request) -> web.Response:
+        await request.json()
+        return web.json_response({'id': next(self._ids)})
+
+    async def add_to_vacancy(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        return web.json_response({'id': next(self._ids), 'status': data['status']})
+
+    async def applicant_log(self, request: web.Request) -> web.Response:
+        logs = [
+            {'id': ind, 'status': settings.HUNTFLOW_REJECTED_STATUS, 'rejection_reason': 1, 'comment': 'x' * 200}
+            for ind in range(self.log_length, 0, -1)
+        ]
+        return self._page(request, logs)
+
+    async def rejection_reasons(self, request: web.Request) -> web.Response:
+        return self._page(request, [{'id': 1, 'name': 'Сам: нашёл другую работу'}, {'id': 2, 'name': 'Другое'}])
+
+    async def upload(self, request: web.Request) -> web.Response:
+        await request.read()
+        if self.upload_latency:
+            await asyncio.sleep(self.upload_latency)
+        self.uploads += 1
+        return web.json_response({'id': next(self._ids), 'name': 'file'})
+
+    async def file(self, request: web.Request) -> web.Response:
+        return web.Response(body=os.urandom(self.file_size))
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware], client_max_size=settings.FILES_MAX_SIZE * 2)
+        app.router.add_get('/account/{account}/applicants', self.applicants)
+        app.router.add_post('/account/{account}/applicants', self.create_applicant)
+        app.router.add_post('/account/{account}/applicants/{id}/vacancy', self.add_to_vacancy)
+        app.router.add_get('/account/{account}/applicants/{id}/log', self.applicant_log)
+        app.router.add_get('/account/{account}/rejection_reasons', self.rejection_reasons)
+        app.router.add_post('/account/{account}/upload', self.upload)
+        app.router.add_get('/files/{name}', self.file)
+        return app
+
+    async def start(self) -> None:
+        self._server = TestServer(self.create_app())
+        await self._server.start_server()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            await self._server.close()
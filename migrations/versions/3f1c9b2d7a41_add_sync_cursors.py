@@ -0,0 +1,29 @@
+"""Add sync_cursors table
+
+Revision ID: 3f1c9b2d7a41
+Revises: eeaf0e41447a
+Create Date: 2026-10-18 10:12:41.118204
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9b2d7a41'
+down_revision = 'eeaf0e41447a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'sync_cursors',
+        sa.Column('status_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('synced_at', sa.DateTime(), nullable=False),
+        sa.Column('full_synced_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('status_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('sync_cursors')
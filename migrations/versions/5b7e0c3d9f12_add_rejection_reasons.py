@@ -0,0 +1,29 @@
+"""Add rejection_reasons table
+
+Revision ID: 5b7e0c3d9f12
+Revises: 8d2e4a6b1c90
+Create Date: 2026-10-18 11:48:05.264771
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5b7e0c3d9f12'
+down_revision = '8d2e4a6b1c90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'rejection_reasons',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('rejection_reasons')
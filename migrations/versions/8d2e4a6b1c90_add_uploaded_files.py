@@ -0,0 +1,33 @@
+"""Add uploaded_files table
+
+Revision ID: 8d2e4a6b1c90
+Revises: 3f1c9b2d7a41
+Create Date: 2026-10-18 11:02:17.530912
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8d2e4a6b1c90'
+down_revision = '3f1c9b2d7a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'uploaded_files',
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('file_id', sa.Integer(), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('last_used_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+    )
+    op.create_index(op.f('ix_uploaded_files_last_used_at'), 'uploaded_files', ['last_used_at'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_uploaded_files_last_used_at'), table_name='uploaded_files')
+    op.drop_table('uploaded_files')
@@ -0,0 +1,30 @@
+"""Add outbox table
+
+Revision ID: a41f6e2c8b37
+Revises: 5b7e0c3d9f12
+Create Date: 2026-10-18 12:35:51.804117
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a41f6e2c8b37'
+down_revision = '5b7e0c3d9f12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'outbox',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('event_type', sa.String(), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('outbox')
@@ -0,0 +1,38 @@
+"""add pending operations
+
+Revision ID: c62d8f1e4a95
+Revises: a41f6e2c8b37
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c62d8f1e4a95'
+down_revision = 'a41f6e2c8b37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'pending_operations',
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('applicant_id', sa.Integer(), nullable=False),
+        sa.Column('operation', sa.String(), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        op.f('ix_pending_operations_applicant_id'), 'pending_operations', ['applicant_id'], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f('ix_pending_operations_applicant_id'), table_name='pending_operations')
+    op.drop_table('pending_operations')
@@ -11,13 +11,40 @@ env = Env()
 env.read_env(override=True)
 
 DB_DSN = env.str('APP_DB_DSN')
+DB_POOL_MIN_SIZE = env.int('APP_DB_POOL_MIN_SIZE', 1)
+DB_POOL_MAX_SIZE = env.int('APP_DB_POOL_MAX_SIZE', 5)
+DB_STATEMENT_CACHE_SIZE = env.int('APP_DB_STATEMENT_CACHE_SIZE', 100)
+DB_POOL_ACQUIRE_TIMEOUT = env.float('APP_DB_POOL_ACQUIRE_TIMEOUT', 10.0)
+DB_APPLICANTS_CACHE_NOTIFY = env.bool('APP_DB_APPLICANTS_CACHE_NOTIFY', False)
+# без NOTIFY кэш не узнаёт о записях других реплик, поэтому по умолчанию включён только вместе с ним
+DB_APPLICANTS_CACHE_ENABLED = env.bool('APP_DB_APPLICANTS_CACHE_ENABLED', DB_APPLICANTS_CACHE_NOTIFY)
+DB_APPLICANTS_CACHE_SIZE = env.int('APP_DB_APPLICANTS_CACHE_SIZE', 1000)
+DB_APPLICANTS_CACHE_RELISTEN_DELAY = env.float('APP_DB_APPLICANTS_CACHE_RELISTEN_DELAY', 5.0)
 
 SERVICE_NAME = 'huntflow-candidates'
 SERVICE_BUS_DSN = env.str('APP_SERVICE_BUS_DSN')
+OUTBOX_BATCH_SIZE = env.int('APP_OUTBOX_BATCH_SIZE', 50)
+OUTBOX_LINGER_SECONDS = env.float('APP_OUTBOX_LINGER_SECONDS', 1.0)
+LEADER_LOCK_ID = env.int('APP_LEADER_LOCK_ID', 7341001)
+RETRY_QUEUE_BASE_DELAY = env.float('APP_RETRY_QUEUE_BASE_DELAY', 30.0)
+RETRY_QUEUE_MAX_DELAY = env.float('APP_RETRY_QUEUE_MAX_DELAY', 60 * 60)
+RETRY_QUEUE_MAX_ATTEMPTS = env.int('APP_RETRY_QUEUE_MAX_ATTEMPTS', 10)
+RETRY_QUEUE_BATCH_SIZE = env.int('APP_RETRY_QUEUE_BATCH_SIZE', 20)
+RETRY_QUEUE_POLL_INTERVAL = env.float('APP_RETRY_QUEUE_POLL_INTERVAL', 10.0)
+BUS_HANDLER_CONCURRENCY = env.int('APP_BUS_HANDLER_CONCURRENCY', 10)
+BUS_HANDLER_TYPE_CONCURRENCY = env.dict('APP_BUS_HANDLER_TYPE_CONCURRENCY', {}, subcast=int)
+# сколько неподтверждённых сообщений listener забирает из шины; по умолчанию столько же, сколько слотов обработчиков,
+# чтобы при занятых слотах новые сообщения оставались в шине, а не копились в памяти
+BUS_PREFETCH = env.int('APP_BUS_PREFETCH', BUS_HANDLER_CONCURRENCY)
 SENTRY_DSN = env.str('SENTRY_DSN', None)
 SENTRY_ENVIRONMENT = env.str('SENTRY_ENVIRONMENT', None)
 
 IE_INTRANET_AD_API = env.str('IE_INTRANET_AD_API')
+IE_INTRANET_AD_MAX_WORKERS = env.int('APP_IE_INTRANET_AD_MAX_WORKERS', 4)
+IE_INTRANET_AD_TIMEOUT = env.float('APP_IE_INTRANET_AD_TIMEOUT', 5.0)
+IE_INTRANET_AD_CACHE_SIZE = env.int('APP_IE_INTRANET_AD_CACHE_SIZE', 1024)
+IE_INTRANET_AD_CACHE_TTL = env.float('APP_IE_INTRANET_AD_CACHE_TTL', 3600.0)
+IE_INTRANET_AD_NEGATIVE_CACHE_TTL = env.float('APP_IE_INTRANET_AD_NEGATIVE_CACHE_TTL', 300.0)
 
 TOKEN = env.str('APP_TOKEN', 'SECRET')
 
@@ -30,8 +57,58 @@ HUNTFLOW_SECURITY_CHECK_STATUS = env.int('APP_HUNTFLOW_SECURITY_CHECK_STATUS', 3
 HUNTFLOW_REJECTED_STATUS = env.int('APP_HUNTFLOW_REJECTED_STATUS', 444)
 HUNTFLOW_RESERVE_STATUS = env.int('APP_HUNTFLOW_RESERVE_STATUS', 555)
 HUNTFLOW_RECOMMENDATION_ACCOUNT_SOURCE = env.str('APP_HUNTFLOW_RECOMMENDATION_ACCOUNT_SOURCE', None)
+HUNTFLOW_JSON_DECODER = env.str('APP_HUNTFLOW_JSON_DECODER', 'auto')
+HUNTFLOW_PAGES_WINDOW = env.int('APP_HUNTFLOW_PAGES_WINDOW', 5)
+HUNTFLOW_READ_RATE = env.float('APP_HUNTFLOW_READ_RATE', 10.0)
+HUNTFLOW_READ_BURST = env.int('APP_HUNTFLOW_READ_BURST', 10)
+HUNTFLOW_WRITE_RATE = env.float('APP_HUNTFLOW_WRITE_RATE', 5.0)
+HUNTFLOW_WRITE_BURST = env.int('APP_HUNTFLOW_WRITE_BURST', 5)
+HUNTFLOW_REJECTION_REASONS_TTL = env.int('APP_HUNTFLOW_REJECTION_REASONS_TTL', 60 * 60)
+HUNTFLOW_RETRY_ATTEMPTS = env.int('APP_HUNTFLOW_RETRY_ATTEMPTS', 3)
+HUNTFLOW_RETRY_MAX_WAIT = env.float('APP_HUNTFLOW_RETRY_MAX_WAIT', 30.0)
+
+HTTP_POOL_SIZE = env.int('APP_HTTP_POOL_SIZE', 50)
+HTTP_POOL_SIZE_PER_HOST = env.int('APP_HTTP_POOL_SIZE_PER_HOST', 10)
+HTTP_KEEPALIVE_TIMEOUT = env.float('APP_HTTP_KEEPALIVE_TIMEOUT', 60.0)
+HTTP_DNS_CACHE_TTL = env.int('APP_HTTP_DNS_CACHE_TTL', 300)
+HTTP_CONNECT_TIMEOUT = env.float('APP_HTTP_CONNECT_TIMEOUT', 5.0)
+HTTP_READ_TIMEOUT = env.float('APP_HTTP_READ_TIMEOUT', 30.0)
+HTTP_TOTAL_TIMEOUT = env.float('APP_HTTP_TOTAL_TIMEOUT', 120.0)
+
+FILES_MAX_SIZE = env.int('APP_FILES_MAX_SIZE', 20 * 1024 * 1024)
+FILES_CHUNK_SIZE = env.int('APP_FILES_CHUNK_SIZE', 64 * 1024)
+FILES_MAX_CONCURRENT_TRANSFERS = env.int('APP_FILES_MAX_CONCURRENT_TRANSFERS', 2)
+FILES_SPOOL_TO_DISK = env.bool('APP_FILES_SPOOL_TO_DISK', True)
+FILES_CACHE_TTL_DAYS = env.int('APP_FILES_CACHE_TTL_DAYS', 30)
+
+REJECTION_CLASSIFICATION_CACHE_SIZE = env.int('APP_REJECTION_CLASSIFICATION_CACHE_SIZE', 1024)
+
+HUNTFLOW_TERMINAL_STATUSES = env.list(
+    'APP_HUNTFLOW_TERMINAL_STATUSES', [HUNTFLOW_REJECTED_STATUS], subcast=int
+)
+
+HUNTFLOW_WEBHOOK_ENABLED = env.bool('APP_HUNTFLOW_WEBHOOK_ENABLED', False)
+HUNTFLOW_WEBHOOK_SECRET = env.str('APP_HUNTFLOW_WEBHOOK_SECRET', None)
+HUNTFLOW_WEBHOOK_DEDUP_SIZE = env.int('APP_HUNTFLOW_WEBHOOK_DEDUP_SIZE', 10000)
+HUNTFLOW_WEBHOOK_DEDUP_TTL = env.float('APP_HUNTFLOW_WEBHOOK_DEDUP_TTL', 24 * 60 * 60)
+
+DIAGNOSTICS_ENABLED = env.bool('APP_DIAGNOSTICS_ENABLED', False)
+DIAGNOSTICS_SLOW_CALLBACK_SECONDS = env.float('APP_DIAGNOSTICS_SLOW_CALLBACK_SECONDS', 0.1)
+DIAGNOSTICS_SAMPLE_INTERVAL = env.float('APP_DIAGNOSTICS_SAMPLE_INTERVAL', 0.01)
+DIAGNOSTICS_MAX_STACKS = env.int('APP_DIAGNOSTICS_MAX_STACKS', 1000)
+DIAGNOSTICS_STACK_DEPTH = env.int('APP_DIAGNOSTICS_STACK_DEPTH', 20)
+DIAGNOSTICS_DUMP_PATH = env.str('APP_DIAGNOSTICS_DUMP_PATH', None)
+METRICS_ENABLED = env.bool('APP_METRICS_ENABLED', True)
+WEB_HOST = env.str('APP_WEB_HOST', '0.0.0.0')
+WEB_PORT = env.int('APP_WEB_PORT', 8080)
 
 APP_SCHEDULER_INTERVAL_MINUTES = env.int('APP_SCHEDULER_INTERVAL_MINUTES', 5)
+APP_SCHEDULER_RECONCILE_INTERVAL_MINUTES = env.int('APP_SCHEDULER_RECONCILE_INTERVAL_MINUTES', 60)
+SYNC_FULL_RESCAN_MINUTES = env.int('APP_SYNC_FULL_RESCAN_MINUTES', 24 * 60)
+SYNC_CONCURRENCY = env.int('APP_SYNC_CONCURRENCY', 4)
+SYNC_QUEUE_SIZE = env.int('APP_SYNC_QUEUE_SIZE', 100)
+SYNC_UPDATE_BATCH_SIZE = env.int('APP_SYNC_UPDATE_BATCH_SIZE', 100)
+SYNC_INDEX_REBUILD_MINUTES = env.int('APP_SYNC_INDEX_REBUILD_MINUTES', 60)
 
 if SENTRY_DSN:
     sentry_logging = LoggingIntegration(
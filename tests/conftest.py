@@ -1,6 +1,7 @@
 import pytest
 import sqlalchemy
 
+from app import database
 from app.models import metadata
 from settings import DB_DSN
 
@@ -12,3 +13,9 @@ def test_database():
     metadata.create_all(engine)
     yield
     metadata.drop_all(engine)
+
+
+@pytest.fixture(autouse=True, scope='function')
+async def database_pool():
+    yield
+    await database.close_pool()
@@ -1,7 +1,21 @@
+import asyncio
+import time
+
 import pytest
+from aiohttp import ClientResponseError
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from mock import Mock
 from mock import patch
 
 from app.huntflow_api import AsyncClient
+from app.huntflow_api import UnknownRejectionReason
+from app.huntflow_api import wait_retry_after
+from app.utlis import transport
+from app.utlis.fast_json import get_decoder
+from app.utlis.rate_limit import TokenBucket
+from app.utlis.rate_limit import parse_retry_after
+from app.utlis.records import record_type
 
 pytestmark = pytest.mark.asyncio
 
@@ -33,3 +47,163 @@ async def test_request_batch_with_chunks():
         items = {'items': f(), 'total': 3}
         request_mock.return_value = items
         assert [1, 2, 3] == [num async for num in client.request_batch('some/path')]
+
+
+async def test_request_pages_window():
+    in_flight = 0
+    max_in_flight = 0
+
+    async def request_get(path, params):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(in_flight, max_in_flight)
+        await asyncio.sleep(0.01 * (10 - params.get('page', 1)))
+        in_flight -= 1
+        return {'items': [params.get('page', 1)], 'total': 8}
+
+    with patch('app.huntflow_api.AsyncClient.request_get', side_effect=request_get):
+        pages = [data['items'][0] async for data in client._request_pages('some/path', None, window=3)]
+        assert pages == list(range(1, 9))
+        assert max_in_flight <= 3
+
+        pages = [data['items'][0] async for data in client._request_pages('some/path', None, ordered=False)]
+        assert sorted(pages) == list(range(1, 9))
+        assert pages != list(range(1, 9))
+
+
+async def test_request_pages_early_stop():
+    cancelled = []
+
+    async def request_get(path, params):
+        try:
+            await asyncio.sleep(0.01 * params.get('page', 0))
+        except asyncio.CancelledError:
+            cancelled.append(params['page'])
+            raise
+        return {'items': [params.get('page', 1)], 'total': 10}
+
+    with patch('app.huntflow_api.AsyncClient.request_get', side_effect=request_get):
+        pages = client._request_pages('some/path', None, window=3)
+        async for data in pages:
+            if data['items'] == [2]:
+                break
+        await pages.aclose()
+        await asyncio.sleep(0)
+        assert sorted(cancelled) == [3, 4, 5]
+
+
+async def test_token_bucket():
+    bucket = TokenBucket(rate=100, capacity=2)
+    started_at = time.monotonic()
+    for _ in range(4):
+        await bucket.acquire()
+    assert 0.015 <= time.monotonic() - started_at < 0.5
+    assert bucket.throttled_requests == 2
+
+    bucket.block(0.05)
+    started_at = time.monotonic()
+    await bucket.acquire()
+    assert time.monotonic() - started_at >= 0.05
+    assert bucket.throttled_requests == 3
+
+    uncontended = TokenBucket(rate=100, capacity=10)
+    for _ in range(10):
+        await uncontended.acquire()
+    assert (uncontended.throttled_requests, uncontended.throttled_seconds) == (0, 0.0)
+
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0, capacity=1)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert parse_retry_after('soon') is None
+
+
+def test_retry_after_is_capped():
+    wait = wait_retry_after(lambda retry_state: 1.0, max_wait=30.0)
+    retry_state = Mock()
+    retry_state.outcome.exception.return_value = ClientResponseError(
+        Mock(), (), status=429, headers={'Retry-After': '3600'}
+    )
+    assert wait(retry_state) == 30.0
+    retry_state.outcome.exception.return_value = ClientResponseError(
+        Mock(), (), status=429, headers={'Retry-After': '3'}
+    )
+    assert wait(retry_state) == 3.0
+
+
+async def test_rejection_reasons_refetch_on_miss():
+    client = AsyncClient('http://localhost', 'TOKEN')
+    client.load_rejection_reasons({1: 'Отказ'}, time.time())
+
+    with patch('app.huntflow_api.AsyncClient.request_get') as request_mock:
+        request_mock.return_value = {'items': [{'id': 1, 'name': 'Отказ'}, {'id': 2, 'name': 'Отказ. САМ'}]}
+        assert await client.get_rejection_reason(1) == 'Отказ'
+        request_mock.assert_not_called()
+
+        assert await client.get_rejection_reason(2) == 'Отказ. САМ'
+        assert request_mock.call_count == 1
+
+        with pytest.raises(UnknownRejectionReason):
+            await client.get_rejection_reason(3)
+        assert request_mock.call_count == 2
+
+        with pytest.raises(UnknownRejectionReason):
+            await client.get_rejection_reason(3)
+        assert request_mock.call_count == 2
+
+
+async def test_rejection_reasons_background_refresh_logs_errors():
+    client = AsyncClient('http://localhost', 'TOKEN')
+    client.load_rejection_reasons({1: 'Отказ'}, time.time() - client.REJECTION_REASONS_TTL - 1)
+
+    with patch('app.huntflow_api.logger') as logger_mock:
+        with patch('app.huntflow_api.AsyncClient.request_get', side_effect=RuntimeError('down')):
+            assert await client.get_rejection_reason(1) == 'Отказ'
+            await asyncio.sleep(0.01)
+
+    logger_mock.error.assert_called_once()
+    assert client._rejection_reasons_refresh is None
+
+
+async def test_request_batch_projects_fields():
+    with patch('app.huntflow_api.AsyncClient.request_get') as request_mock:
+        request_mock.return_value = {'items': [{'id': 1, 'status': 2, 'comment': 'long text'}]}
+        records = [item async for item in client.request_batch('some/path', fields=('id', 'status'))]
+
+    assert records == [record_type(('id', 'status')).from_dict({'id': 1, 'status': 2})]
+    assert (records[0]['id'], records[0].get('status'), records[0].get('comment', 'none')) == (1, 2, 'none')
+    assert not hasattr(records[0], '__dict__')
+    with pytest.raises(KeyError):
+        records[0]['comment']
+
+
+def test_json_decoder():
+    assert get_decoder('auto')(b'{"items": [1]}') == {'items': [1]}
+    assert get_decoder('json')('{"id": 1}') == {'id': 1}
+    with pytest.raises(ValueError):
+        get_decoder('unknown')
+
+
+async def test_shared_connector_outlives_sessions():
+    async def ping(request):
+        return web.Response(text='pong')
+
+    app = web.Application()
+    app.router.add_get('/ping', ping)
+    async with TestServer(app) as server:
+        connector = transport.get_connector()
+        session = transport.create_session()
+        await session.close()
+        assert session.closed and not connector.closed
+
+        shared = transport.get_session()
+        assert shared.connector is connector
+        async with shared.get(server.make_url('/ping')) as resp:
+            assert await resp.text() == 'pong'
+
+        await transport.close()
+        assert shared.closed and connector.closed
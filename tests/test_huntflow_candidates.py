@@ -1,13 +1,22 @@
+import asyncio
 import datetime
+import hashlib
+import hmac
+import json
 from unittest.mock import Mock
 import logging
 import time
 
 import pytest
+from aiohttp import ClientConnectionError
+from aiohttp import ClientResponseError
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
 from mock import patch
 
 import app.database as database
 import settings
+from app.applicant_index import ApplicantIndex
 from app.bus_service import ApplicantAlreadyRecommended
 from app.bus_service import ApplicantRejected
 from app.bus_service import ApplicantSBRejected
@@ -19,15 +28,26 @@ from app.bus_service import ApplicantSecurityCheckPrepared
 from app.bus_service import ApplicantSelfRejected
 from app.bus_service import Inviter
 from app.bus_service import VacancyRecommendationSubmitted
+from app.diagnostics import Diagnostics
+from app.event_handlers import build_applicant_rejected_event
+from app.event_handlers import classify_rejection
 from app.event_handlers import push_arms_failed
+from app.file_cache import uploaded_files_cache
+from app.handler_executor import HandlerExecutor
 from app.event_handlers import push_arms_filled
 from app.event_handlers import push_arms_finished
 from app.event_handlers import push_arms_url_to_huntflow
 from app.event_handlers import push_candidate_to_huntflow
 from app.event_handlers import render_resume
 from app.huntflow_api import AsyncClient
+from app.intranet_ad import ad_client
+from app.leader import LeaderElection
 from app.sync import sync_applicant_vacancy_statuses
 from app.models import SyncError
+from app.outbox import outbox_relay
+from app.retry_queue import retry_queue
+from app.utlis import files as files_utils
+from app.web import create_app
 
 client = AsyncClient('http://localhost', 'TOKEN')
 
@@ -125,17 +145,15 @@ async def test_recommendation_push_to_vacancy(request_mock):
     )
 
 
-@patch('app.huntflow_api.AsyncClient.account_upload_files')
-@patch('app.utlis.files.download_files')
+@patch('app.utlis.files.relay_files')
 @patch('app.huntflow_api.AsyncClient.push_candidate')
 @patch('app.huntflow_api.AsyncClient.push_candidate_to_vacancy')
 @patch('chassis.clients.ie_intranet_ad.Client.get_users')
 async def test_push_candidate(
-    get_users_mock, push_to_vacancy_mock, push_candidate_mock, download_files_mock, upload_files_mock
+    get_users_mock, push_to_vacancy_mock, push_candidate_mock, relay_files_mock
 ):
-    download_files_mock.return_value = [b'1', b'2']
     get_users_mock.return_value = [Mock(mail='user1@tochka.com')]
-    upload_files_mock.return_value = [{'id': 1}, {'id': 2}]
+    relay_files_mock.return_value = [{'id': 1}, {'id': 2}]
     push_candidate_mock.return_value = 456
     push_to_vacancy_mock.return_value = 789
     await push_candidate_to_huntflow(VacancyRecommendationSubmitted(**candidate))
@@ -148,7 +166,8 @@ async def test_push_candidate(
         'last_sync_error': None
     }
 
-    download_files_mock.assert_called_once_with(['url1', 'url2'])
+    relay_files_mock.assert_called_once()
+    assert relay_files_mock.call_args[0][0] == ['url1', 'url2']
 
     push_candidate_mock.assert_called_once_with(**{
         'first_name': candidate['first_name'],
@@ -161,6 +180,63 @@ async def test_push_candidate(
     push_to_vacancy_mock.assert_called_once_with(456, files_ids=[1, 2])
 
 
+@patch.object(ad_client, 'timeout', 0.1)
+@patch('chassis.clients.ie_intranet_ad.Client.get_users')
+async def test_ad_lookup_timeout(get_users_mock):
+    get_users_mock.side_effect = lambda username: time.sleep(0.5)
+    ad_client.clear_cache()
+    started_at = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        await ad_client.get_user_email('slowuser')
+    with pytest.raises(asyncio.TimeoutError):
+        await ad_client.get_user_email('slowuser')
+    assert time.monotonic() - started_at < 0.5
+    assert get_users_mock.call_count == 1
+    assert 'slowuser' not in ad_client._emails
+
+
+@patch('chassis.clients.ie_intranet_ad.Client.get_users')
+async def test_ad_lookup_cache(get_users_mock):
+    get_users_mock.side_effect = lambda username: (
+        [Mock(mail=f'{username}@tochka.com')] if username == 'known' else []
+    )
+    ad_client.clear_cache()
+
+    assert await asyncio.gather(*[ad_client.get_user_email('known') for _ in range(3)]) == ['known@tochka.com'] * 3
+    assert await ad_client.get_user_email('known') == 'known@tochka.com'
+    assert await ad_client.get_user_email('unknown') == ''
+    assert await ad_client.get_user_email('unknown') == ''
+    assert get_users_mock.call_count == 2
+
+
+async def test_relay_file_size_limit():
+    async def iter_chunked(size):
+        for _ in range(3):
+            yield b'x' * size
+
+    resp = Mock(content_length=None)
+    resp.content.iter_chunked = iter_chunked
+    with patch.object(settings, 'FILES_MAX_SIZE', settings.FILES_CHUNK_SIZE * 2):
+        with pytest.raises(files_utils.FileTooLargeError):
+            assert [chunk async for chunk in files_utils.FileChunks(resp, 'url')]
+
+
+async def test_uploaded_files_cache():
+    hits, misses = uploaded_files_cache.hits, uploaded_files_cache.misses
+    assert await uploaded_files_cache.get_by_url('url1') is None
+    await uploaded_files_cache.record_upload('url1', 'digest', 1, 100)
+    assert await uploaded_files_cache.get_by_url('url1') == {'id': 1}
+    assert await uploaded_files_cache.get_by_digest('digest') == {'id': 1}
+    assert uploaded_files_cache.bytes_saved >= 200
+    assert (uploaded_files_cache.hits - hits, uploaded_files_cache.misses - misses) == (2, 1)
+
+    await uploaded_files_cache.purge_expired()
+    assert await uploaded_files_cache.get_by_url('url1') == {'id': 1}
+    with patch.object(uploaded_files_cache, 'ttl', datetime.timedelta(0)):
+        await uploaded_files_cache.purge_expired()
+    assert await uploaded_files_cache.get_by_url('url1') is None
+
+
 async def test_db_queries():
     await database.create_applicant(123)
     applicant = await database.get_applicant_by_id(123)
@@ -202,6 +278,20 @@ async def test_db_queries():
         'last_sync_error': None,
     }
 
+    await database.update_applicants_statuses([
+        (123, 111, SyncError.no_rejection_reason),
+        (1, None, None),
+    ])
+    applicant = await database.get_applicant_by_id(123)
+    assert (applicant['status_id'], applicant['last_sync_error']) == (111, SyncError.no_rejection_reason)
+    applicant = await database.get_applicant_by_id(1)
+    assert (applicant['status_id'], applicant['last_sync_error']) == (3, None)
+
+    database.applicants_cache.clear()
+    with patch.object(database.applicants_cache, 'enabled', True):
+        assert dict(await database.get_applicant_by_id(123)) == dict(await database.get_applicant_by_id(123))
+        assert database.applicants_cache.get(123)['last_sync_error'] == SyncError.no_rejection_reason
+
 
 @patch('bus.sender.Sender.send')
 @patch('app.huntflow_api.AsyncClient.request_get')
@@ -219,6 +309,7 @@ async def test_sync_secure_check_applicants_statuses(request_mock, send_mock):
     applicant = await database.get_applicant_by_id(111)
     assert applicant['status_id'] == 111
 
+    assert await outbox_relay.relay_pending() == 1
     send_mock.assert_called_with(ApplicantSecurityCheckPrepared(id=123))
 
 
@@ -249,6 +340,7 @@ async def test_sync_rejected_applicants_statuses(
     await sync_applicant_vacancy_statuses()
     applicant = await database.get_applicant_by_id(123)
     assert applicant['status_id'] == settings.HUNTFLOW_REJECTED_STATUS
+    assert await outbox_relay.relay_pending() == 1
     send_mock.assert_called_once_with(event_cls(id=123))
 
 
@@ -281,6 +373,62 @@ async def test_sync_rejected_applicatns_no_rejection_reason(
     check_no_errors()
 
 
+@patch('app.huntflow_api.AsyncClient.get_rejection_reason')
+@patch('bus.sender.Sender.send')
+@patch('app.huntflow_api.AsyncClient.request_get')
+@patch('app.huntflow_api.AsyncClient.get_applicant_log')
+async def test_incremental_sync_skips_terminal_applicants(log_mock, request_mock, send_mock, get_reason_mock):
+    get_reason_mock.return_value = 'Отказ. МЫ: нехороший человек'
+    request_mock.side_effect = lambda path, params: (
+        {'items': ([{'id': 789}] if params.get('status') == settings.HUNTFLOW_REJECTED_STATUS else [])}
+    )
+
+    async def get_log_items(hf_id):
+        yield {'id': 789, 'status': settings.HUNTFLOW_REJECTED_STATUS, 'rejection_reason': 123}
+
+    log_mock.side_effect = get_log_items
+    await database.create_applicant(123, 789, 456)
+    await sync_applicant_vacancy_statuses()
+    assert request_mock.call_count == 3
+
+    request_mock.reset_mock()
+    await sync_applicant_vacancy_statuses()
+    request_mock.assert_not_called()
+    assert await outbox_relay.relay_pending() == 1
+    send_mock.assert_called_once_with(ApplicantRejected(id=123))
+
+
+@patch('app.huntflow_api.AsyncClient.get_rejection_reason')
+@patch('app.huntflow_api.AsyncClient.request_get')
+async def test_rejected_event_stops_at_first_rejection(request_mock, get_reason_mock):
+    get_reason_mock.return_value = 'Отказ. САМ: не хочет работать'
+    request_mock.return_value = {
+        'items': [
+            {'id': 3, 'status': 111},
+            {'id': 2, 'status': settings.HUNTFLOW_REJECTED_STATUS, 'rejection_reason': 123},
+            {'id': 1, 'status': settings.HUNTFLOW_REJECTED_STATUS, 'rejection_reason': 456},
+        ],
+        'total': 5,
+    }
+
+    assert await build_applicant_rejected_event(123, 789) == ApplicantSelfRejected(id=123)
+    assert request_mock.call_count == 1
+    get_reason_mock.assert_called_once_with(123)
+
+
+@patch('app.huntflow_api.AsyncClient.get_rejection_reason')
+async def test_classify_rejection_is_memoized(get_reason_mock):
+    get_reason_mock.return_value = 'Отказ. МЫ: Не прошел СБ'
+    log = {'id': 1001, 'status': settings.HUNTFLOW_REJECTED_STATUS, 'rejection_reason': 123}
+
+    assert await classify_rejection(789, log) is ApplicantSBRejected
+    assert await classify_rejection(789, dict(log)) is ApplicantSBRejected
+    assert get_reason_mock.call_count == 1
+
+    assert await classify_rejection(789, dict(log, rejection_reason=456)) is ApplicantSBRejected
+    assert get_reason_mock.call_count == 2
+
+
 @patch('bus.sender.Sender.send')
 @patch('app.huntflow_api.AsyncClient.request_get')
 async def test_sync_self_reserved_applicants_statuses(request_mock, send_mock):
@@ -291,6 +439,65 @@ async def test_sync_self_reserved_applicants_statuses(request_mock, send_mock):
     await sync_applicant_vacancy_statuses()
     applicant = await database.get_applicant_by_id(123)
     assert applicant['status_id'] == settings.HUNTFLOW_RESERVE_STATUS
+    assert await outbox_relay.relay_pending() == 1
+    send_mock.assert_called_once_with(ApplicantAlreadyRecommended(id=123))
+
+
+@patch.object(settings, 'HUNTFLOW_WEBHOOK_ENABLED', True)
+@patch.object(settings, 'HUNTFLOW_WEBHOOK_SECRET', 'secret')
+@patch('bus.sender.Sender.send')
+async def test_huntflow_webhook(send_mock):
+    await database.create_applicant(123, 789, 456)
+    body = json.dumps({
+        'event': {
+            'applicant': {'id': 789},
+            'applicant_log': {
+                'id': 1,
+                'status': {'id': settings.HUNTFLOW_RESERVE_STATUS},
+                'vacancy': {'id': settings.HUNTFLOW_REFERRAL_VACANCY},
+            },
+        },
+    }).encode()
+    headers = {
+        'X-Huntflow-Event': 'APPLICANT',
+        'X-Huntflow-Signature': hmac.new(b'secret', body, hashlib.sha256).hexdigest(),
+    }
+
+    async with TestClient(TestServer(create_app())) as http_client:
+        resp = await http_client.post(
+            '/webhooks/huntflow', data=body, headers=dict(headers, **{'X-Huntflow-Signature': 'invalid'})
+        )
+        assert resp.status == 403
+        resp = await http_client.post('/webhooks/huntflow', data=body, headers=headers)
+        assert (resp.status, await resp.text()) == (200, 'ok')
+        resp = await http_client.post('/webhooks/huntflow', data=body, headers=headers)
+        assert (resp.status, await resp.text()) == (200, 'duplicate')
+        bad_body = b'[1, 2]'
+        resp = await http_client.post('/webhooks/huntflow', data=bad_body, headers=dict(
+            headers, **{'X-Huntflow-Signature': hmac.new(b'secret', bad_body, hashlib.sha256).hexdigest()}
+        ))
+        assert resp.status == 400
+
+    with patch.object(settings, 'HUNTFLOW_WEBHOOK_SECRET', None):
+        async with TestClient(TestServer(create_app())) as http_client:
+            resp = await http_client.post('/webhooks/huntflow', data=body, headers=headers)
+            assert resp.status == 404
+
+    applicant = await database.get_applicant_by_id(123)
+    assert applicant['status_id'] == settings.HUNTFLOW_RESERVE_STATUS
+    assert await outbox_relay.relay_pending() == 1
+    send_mock.assert_called_once_with(ApplicantAlreadyRecommended(id=123))
+
+
+@patch('bus.sender.Sender.send')
+async def test_status_change_is_applied_once(send_mock):
+    await database.create_applicant(123, 789, 456)
+    change = [(123, settings.HUNTFLOW_RESERVE_STATUS, None)]
+    results = await asyncio.gather(*[
+        database.update_applicants_statuses(change, [ApplicantAlreadyRecommended(id=123)]) for _ in range(2)
+    ])
+    assert sorted(results, key=len) == [set(), {123}]
+    assert await outbox_relay.relay_pending() == 1
     send_mock.assert_called_once_with(ApplicantAlreadyRecommended(id=123))
 
 
@@ -362,3 +569,234 @@ async def test_push_arms_finished_event_to_huntflow(request_mock):
             'rejection_reason': None
         }
     )
+
+
+async def test_handler_executor_limits():
+    executor = HandlerExecutor(Mock(), concurrency=3, type_concurrency={'ApplicantSecurityCheckFilled': 1})
+    max_in_flight = {'ApplicantSecurityCheckFilled': 0, 'ApplicantSecurityCheckFailed': 0}
+
+    async def handle(event):
+        event_type = type(event).__name__
+        max_in_flight[event_type] = max(max_in_flight[event_type], executor.in_flight[event_type])
+        assert executor.in_flight_total <= 3
+        await asyncio.sleep(0.01)
+
+    filled = executor.on(ApplicantSecurityCheckFilled)(handle)
+    failed = executor.on(ApplicantSecurityCheckFailed)(handle)
+    await asyncio.gather(
+        *[filled(ApplicantSecurityCheckFilled(id=i)) for i in range(5)],
+        *[failed(ApplicantSecurityCheckFailed(id=i, arms_id='1', candidate_url='url')) for i in range(5)],
+    )
+    assert max_in_flight['ApplicantSecurityCheckFilled'] == 1
+    assert 1 < max_in_flight['ApplicantSecurityCheckFailed'] <= 3
+    assert executor.queue_depth == executor.in_flight_total == 0
+
+
+async def test_handler_executor_stops_intake_when_saturated():
+    class PrefetchListener:
+        """
+        Listener, который, как шина с prefetch, не отдаёт больше prefetch неподтверждённых сообщений
+        """
+
+        def __init__(self, prefetch):
+            self.prefetch = asyncio.Semaphore(prefetch)
+            self.handler = None
+            self.taken = 0
+
+        def on(self, event_cls):
+            def decorator(func):
+                self.handler = func
+                return func
+            return decorator
+
+        async def listen(self, events):
+            async def deliver(event):
+                try:
+                    await self.handler(event)
+                finally:
+                    self.prefetch.release()
+
+            tasks = []
+            for event in events:
+                await self.prefetch.acquire()
+                self.taken += 1
+                tasks.append(asyncio.ensure_future(deliver(event)))
+            await asyncio.gather(*tasks)
+
+    listener = PrefetchListener(settings.BUS_PREFETCH)
+    executor = HandlerExecutor(listener, concurrency=settings.BUS_HANDLER_CONCURRENCY, type_concurrency={})
+    release = asyncio.Event()
+
+    async def handle(event):
+        await release.wait()
+
+    executor.on(ApplicantSecurityCheckFilled)(handle)
+    listening = asyncio.ensure_future(
+        listener.listen([ApplicantSecurityCheckFilled(id=i) for i in range(settings.BUS_HANDLER_CONCURRENCY + 5)])
+    )
+    await asyncio.sleep(0.01)
+    assert executor.in_flight_total == listener.taken == settings.BUS_HANDLER_CONCURRENCY
+    assert executor.queue_depth == 0
+
+    release.set()
+    await listening
+    assert listener.taken == settings.BUS_HANDLER_CONCURRENCY + 5
+
+
+async def test_handler_executor_orders_events_by_applicant():
+    executor = HandlerExecutor(Mock(), concurrency=10, type_concurrency={})
+    handled = []
+
+    async def handle(event):
+        await asyncio.sleep(0.02 if isinstance(event, ApplicantSecurityCheckCreated) else 0.001)
+        handled.append((event.id, type(event).__name__))
+
+    created = executor.on(ApplicantSecurityCheckCreated, ordered_by='id')(handle)
+    filled = executor.on(ApplicantSecurityCheckFilled, ordered_by='id')(handle)
+    await asyncio.gather(*[
+        coro for i in range(3) for coro in (
+            created(ApplicantSecurityCheckCreated(
+                id=i, arms_id='1', arms_url='url', arms_created_at=datetime.datetime.now()
+            )),
+            filled(ApplicantSecurityCheckFilled(id=i)),
+        )
+    ])
+    for i in range(3):
+        assert [name for id_, name in handled if id_ == i] == [
+            'ApplicantSecurityCheckCreated', 'ApplicantSecurityCheckFilled'
+        ]
+    assert len(executor.lanes) == 0
+
+
+@patch('app.huntflow_api.AsyncClient.request_post')
+async def test_failed_push_is_retried_in_order(request_mock):
+    await database.create_applicant(123, 456, 789)
+    request_mock.side_effect = [
+        ClientConnectionError('huntflow is down'),
+        {'status': settings.HUNTFLOW_SECURITY_CHECK_STATUS},
+        {'status': settings.HUNTFLOW_SECURITY_CHECK_STATUS},
+    ]
+
+    with patch.object(retry_queue, 'base_delay', 0):
+        await push_arms_filled(ApplicantSecurityCheckFilled(id=123))
+        await push_arms_failed(ApplicantSecurityCheckFailed(id=123, arms_id='1', candidate_url='url'))
+        assert request_mock.call_count == 1
+        assert await database.has_pending_operations(123)
+
+        assert await retry_queue.drain() == 1
+        assert await retry_queue.drain() == 1
+    assert await retry_queue.drain() == 0
+    assert not await database.has_pending_operations(123)
+    assert [call.args[1]['comment'] for call in request_mock.call_args_list] == [
+        'Анкета СБ заполнена', 'Анкета СБ заполнена', 'Анкета СБ была заполнена некорректно.'
+    ]
+
+
+@patch('app.huntflow_api.AsyncClient.request_post')
+async def test_non_retryable_errors_are_not_queued(request_mock):
+    await database.create_applicant(123, 456, 789)
+    request_mock.side_effect = ClientResponseError(Mock(), (), status=400)
+    with pytest.raises(ClientResponseError):
+        await push_arms_filled(ApplicantSecurityCheckFilled(id=123))
+    assert not await database.has_pending_operations(123)
+
+    request_mock.side_effect = [ClientConnectionError('huntflow is down'), ClientResponseError(Mock(), (), status=400)]
+    with patch.object(retry_queue, 'base_delay', 0):
+        await push_arms_filled(ApplicantSecurityCheckFilled(id=123))
+        assert await retry_queue.drain() == 1
+    assert not await database.has_pending_operations(123)
+    assert await database.count_dead_operations() == 1
+
+
+async def test_leader_election_failover():
+    first, second = LeaderElection(lock_id=42), LeaderElection(lock_id=42)
+    try:
+        assert await first.acquire()
+        assert await first.acquire()
+        assert not await second.acquire()
+
+        await first.close()
+        assert await second.acquire()
+        assert not await first.acquire()
+    finally:
+        await first.close()
+        await second.close()
+
+
+@patch('app.huntflow_api.AsyncClient.request_post')
+async def test_metrics_endpoint(request_mock):
+    await database.create_applicant(123, 456, 789)
+    await push_arms_filled(ApplicantSecurityCheckFilled(id=123))
+
+    async with TestClient(TestServer(create_app())) as http_client:
+        resp = await http_client.get('/metrics')
+        assert resp.status == 200
+        text = await resp.text()
+
+    assert 'db_queries_total{function="create_applicant",result="ok"}' in text
+    assert 'bus_handler_events_total{event_type="ApplicantSecurityCheckFilled",result="ok"}' in text
+    assert 'huntflow_throttled_requests_total{limiter="write"}' in text
+
+
+async def test_diagnostics_samples_blocking_calls():
+    diagnostics = Diagnostics(
+        slow_callback_duration=0.05, sample_interval=0.005, max_stacks=100, stack_depth=5
+    )
+
+    def block_loop():
+        time.sleep(0.2)
+
+    diagnostics.enable(asyncio.get_event_loop())
+    try:
+        block_loop()
+    finally:
+        diagnostics.disable()
+
+    assert diagnostics.total_samples > 0
+    assert 'block_loop' in diagnostics.report()
+
+
+def test_applicant_index():
+    index = ApplicantIndex()
+    index.begin_rebuild()
+    index.apply({'id': 5, 'applicant_id': 50})
+    index.load([
+        {'id': 1, 'applicant_id': 30, 'status_id': 7},
+        {'id': 2, 'applicant_id': None, 'status_id': None},
+        {'id': 3, 'applicant_id': 10, 'status_id': None},
+    ])
+    assert (index.get(30), index.get(10), index.get(50), index.get(99)) == ((1, 7), (3, None), (5, None), None)
+
+    index.apply({'id': 2, 'applicant_id': 20})
+    index.apply({'id': 3, 'status_id': 9})
+    index.apply({'id': 1, 'applicant_id': 31})
+    assert (index.get(20), index.get(10), index.get(30), index.get(31)) == ((2, None), (3, 9), None, (1, 7))
+    assert list(index.statuses_in_huntflow()) == [7, None, 9, None]
+    assert len(index) == 4 and index.complete
+
+    index.begin_rebuild()
+    index.add_row(4, 40, None)
+    index.finish_rebuild(complete=False)
+    assert (index.get(40), index.get(31), len(index), index.complete) == ((4, None), None, 1, False)
+
+
+def test_applicants_cache_skips_rows_changed_during_fetch():
+    cache = database.ApplicantCache(size=10)
+    with cache.fetching(1) as put_fetched:
+        cache.update(1, {'status_id': 2})
+        put_fetched({'id': 1, 'status_id': 1})
+    assert cache.get(1) is None
+
+    with cache.fetching(1) as put_fetched:
+        put_fetched({'id': 1, 'status_id': 2})
+    assert cache.get(1) == {'id': 1, 'status_id': 2}
+
+
+async def test_spawned_tasks_get_own_connection():
+    async def current_connection():
+        return database.database.connection()
+
+    await database.get_sync_cursors()
+    parent = database.database.connection()
+    assert await asyncio.ensure_future(current_connection()) is parent
+    assert await database.spawn(current_connection()) is not parent